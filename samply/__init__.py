@@ -8,6 +8,7 @@ logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s %(message)s',
 from sqlalchemy import create_engine  # noqa
 
 from samply.cli import cli  # noqa
+from samply.cli import TABLES  # noqa
 from samply.database import init  # noqa
 from samply.contributors import Contributors  # noqa
 from samply.contributors import SampleContribution  # noqa
@@ -16,7 +17,11 @@ from samply.taxon import SampleTaxon  # noqa
 from samply.samples import Samples  # noqa
 from samply.pesticides import Pesticide  # noqa
 from samply.pesticides import SamplePesticide  # noqa
+from samply import backup  # noqa
+from samply import export  # noqa
+from samply import indexes  # noqa
 from samply import utils  # noqa
+from samply.base import write_frames  # noqa
 
 logger = logging.getLogger("samply")
 
@@ -41,10 +46,24 @@ def main():
 
     if args.command == "init":
         init(args.db)
+    elif args.command == "migrate":
+        run_migrate(args)
     elif args.command == "add":
         run_add(args)
     elif args.command == "dump":
         run_dump(args)
+    elif args.command == "export":
+        run_export(args)
+    elif args.command == "taxon":
+        run_taxon(args)
+    elif args.command == "lineage":
+        run_lineage(args)
+    elif args.command == "spatial":
+        run_spatial(args)
+    elif args.command == "resolve":
+        run_resolve(args)
+    elif args.command == "index":
+        run_index(args)
     else:
         print("NO SUBCOMMAND USED")
         print(args)
@@ -71,24 +90,239 @@ def get_table(table):
         raise ValueError("No table provided")
 
 
+@utils.log(logger, logging.DEBUG)
+def run_migrate(args):
+    engine = create_engine(args.db)
+
+    migrated = []
+    for name in TABLES:
+        table = get_table(name)
+        if table not in migrated:
+            table(engine).migrate()
+            migrated.append(table)
+    return
+
+
 @utils.log(logger, logging.DEBUG)
 def run_add(args):
     engine = create_engine(args.db)
 
     table = get_table(args.table)
 
-    tab = table(engine)
-    tab.add_file(args.file)
+    if args.file == "-":
+        path = sys.stdin
+    else:
+        path = args.file
+
+    options = {}
+    if args.server_buffer:
+        options["server_buffer"] = True
+
+    if args.drop_indexes:
+        indexes.drop_indexes(engine)
+
+    try:
+        tab = table(engine, bulk=args.bulk, mode=args.mode, **options)
+        tab.add_file(
+            path,
+            chunksize=args.chunk_size,
+            resume=args.resume,
+            format=args.format
+        )
+    finally:
+        if args.drop_indexes:
+            indexes.create_indexes(engine)
     return
 
 
 @utils.log(logger, logging.DEBUG)
 def run_dump(args):
+    if args.all:
+        return run_dump_all(args)
+
     engine = create_engine(args.db)
 
     table = get_table(args.table)
 
     tab = table(engine)
-    df = tab.dump()
-    df.to_csv(args.output, index=False, sep="\t")
+    write_dump(tab, args)
+    return
+
+
+@utils.log(logger, logging.DEBUG)
+def run_export(args):
+    engine = create_engine(args.db)
+
+    view = export.VIEWS[args.view]
+
+    tab = view(engine)
+    write_dump(tab, args)
+    return
+
+
+@utils.log(logger, logging.DEBUG)
+def run_taxon(args):
+    engine = create_engine(args.db)
+
+    tab = Taxon(engine)
+
+    if args.query == "rebuild":
+        tab.rebuild_hierarchy()
+        return
+    elif args.query == "lca":
+        print(tab.lowest_common_ancestor(args.taxids))
+        return
+    elif args.query == "descendants":
+        table = tab.descendants(args.taxids[0], depth=args.depth)
+    elif args.query == "ancestors":
+        table = tab.ancestors(args.taxids[0])
+    elif args.query == "samples":
+        table = tab.samples(args.taxids[0])
+
+    table.to_csv(sys.stdout, index=False, sep="\t")
+    return
+
+
+@utils.log(logger, logging.DEBUG)
+def run_lineage(args):
+    engine = create_engine(args.db)
+
+    table = get_table(args.table)
+
+    tab = table(engine)
+    nodes, edges = tab.lineage(args.key, up=args.up, depth=args.depth)
+
+    if args.edges:
+        edges.to_csv(sys.stdout, index=False, sep="\t")
+    else:
+        nodes.to_csv(sys.stdout, index=False, sep="\t")
+    return
+
+
+@utils.log(logger, logging.DEBUG)
+def run_spatial(args):
+    engine = create_engine(args.db)
+
+    tab = Samples(engine)
+    tab.spatial_index()
+
+    if args.query == "index":
+        return
+
+    where = dump_filters(tab, args)
+    if args.query == "contains":
+        where.append(tab.contains(*args.coords))
+    elif args.query == "within":
+        lon, lat, km = args.coords
+        where.append(tab.within(lon, lat, km * 1000))
+    elif args.query == "bbox":
+        where.append(tab.bbox(*args.coords))
+    elif args.query == "nearest":
+        frame = tab.nearest(*args.coords, n=args.n, where=where)
+        types = dict(tab.dump_types, distance="float")
+        write_output([frame], types, args)
+        return
+
+    write_output(tab.dump_batches(args.batch_size, where=where),
+                 tab.dump_types, args)
+    return
+
+
+@utils.log(logger, logging.DEBUG)
+def run_resolve(args):
+    engine = create_engine(args.db)
+
+    tab = get_table(args.table)(engine)
+    if args.rebuild:
+        tab.rebuild_names()
+
+    names = list(args.names)
+    if args.names_file is not None:
+        names.extend(
+            line.strip() for line in args.names_file
+            if line.strip() != ""
+        )
+
+    table = tab.resolve(names, min_score=args.min_score)
+    table.to_csv(sys.stdout, index=False, sep="\t")
+    return
+
+
+@utils.log(logger, logging.DEBUG)
+def run_index(args):
+    engine = create_engine(args.db)
+
+    names = None if len(args.names) == 0 else args.names
+    if args.action == "create":
+        indexes.create_indexes(engine, names)
+    elif args.action == "drop":
+        indexes.drop_indexes(engine, names)
+    elif args.action == "status":
+        table = indexes.index_status(engine)
+        table.to_csv(sys.stdout, index=False, sep="\t")
+    return
+
+
+def dump_filters(tab, args):
+    """ The filters given with the dump options. """
+
+    where = list(args.where)
+    if args.permission is not None:
+        where.append("permission=" + args.permission)
+    if args.bbox is not None:
+        where.append(tab.bbox(*args.bbox))
+    if args.overlaps is not None:
+        where.append(tab.overlapping(*args.overlaps))
+    if args.during is not None:
+        where.append(tab.during(*args.during))
+    return where
+
+
+def write_dump(tab, args):
+    """ Write a table or view to the output with the dump options. """
+
+    where = dump_filters(tab, args)
+    batches = tab.dump_batches(args.batch_size, where=where)
+    write_output(batches, tab.dump_types, args)
+    return
+
+
+def write_output(frames, types, args):
+    """ Write DataFrames to the output file or stdout in the format. """
+
+    if args.output is not None:
+        mode = "w" if args.format == "tsv" else "wb"
+        with open(args.output, mode) as handle:
+            write_frames(frames, handle, types, args.format)
+    elif args.format == "tsv":
+        write_frames(frames, sys.stdout, types)
+    else:
+        write_frames(frames, sys.stdout.buffer, types, args.format)
+    return
+
+
+@utils.log(logger, logging.DEBUG)
+def run_dump_all(args):
+    # Aliases name the same table, so dump each class once.
+    tables = {}
+    for name in TABLES:
+        table = get_table(name)
+        if table not in tables.values():
+            tables[name] = table
+
+    jobs = len(tables) if args.jobs is None else args.jobs
+
+    # One connection per worker plus the one holding the snapshot.
+    engine = create_engine(args.db)
+    if engine.dialect.name == "postgresql":
+        engine = create_engine(args.db, pool_size=jobs + 1)
+
+    backup.dump_all(
+        engine,
+        tables,
+        args.outdir,
+        format=args.format,
+        batch_size=args.batch_size,
+        jobs=jobs
+    )
     return
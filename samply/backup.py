@@ -0,0 +1,117 @@
+"""
+Dumping every table at once from one consistent snapshot.
+
+On postgres a leading transaction exports its snapshot with
+pg_export_snapshot(), and each table is dumped in its own REPEATABLE READ
+transaction that imports it, so all of the files see the same data.
+"""
+
+import os
+import logging
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+
+def snapshots_available(engine):
+    return engine.dialect.name == "postgresql"
+
+
+@contextmanager
+def export_snapshot(engine):
+    """ Hold open a transaction and yield its exported snapshot id.
+
+    Yields None for databases that can't export snapshots.
+    The snapshot can only be imported while this context is open.
+    """
+
+    if not snapshots_available(engine):
+        logger.warning(
+            "Consistent snapshots are only supported for postgres, "
+            "tables will be dumped independently."
+        )
+        yield None
+        return
+
+    with engine.connect() as connection:
+        connection = connection.execution_options(
+            isolation_level="REPEATABLE READ")
+        with connection.begin():
+            snapshot = connection.execute(
+                text("SELECT pg_export_snapshot()")).scalar()
+            logger.debug("Exported snapshot %s.", snapshot)
+            yield snapshot
+    return
+
+
+def use_snapshot(session, snapshot):
+    """ Start the session's transaction in an exported snapshot.
+
+    Must be called before anything else is executed in the transaction.
+    """
+
+    session.connection(execution_options={
+        "isolation_level": "REPEATABLE READ"})
+    session.execute(
+        text("SET TRANSACTION SNAPSHOT :snapshot"),
+        {"snapshot": snapshot}
+    )
+    return
+
+
+def dump_path(outdir, name, format="tsv"):
+    return os.path.join(outdir, "{}.{}".format(name, format))
+
+
+def dump_all(engine, tables, outdir, format="tsv", batch_size=10000,
+             jobs=None):
+    """ Dump several tables to files in outdir in parallel.
+
+    Keyword arguments:
+    engine -- The engine to connect with. Each worker checks out its own
+        connection from the engine's pool, so it should hold at least
+        jobs + 1 connections.
+    tables -- A dict mapping file names to SamplyBase subclasses.
+    outdir -- The directory to write to, created if it doesn't exist.
+    format -- One of "tsv", "parquet" or "arrow".
+    batch_size -- The number of rows to fetch and write at a time.
+    jobs -- The number of tables to dump at once. Default = all of them.
+
+    Returns:
+    A dict mapping names to the paths written.
+    """
+
+    os.makedirs(outdir, exist_ok=True)
+    if jobs is None:
+        jobs = len(tables)
+
+    paths = {n: dump_path(outdir, n, format) for n in tables}
+
+    def dump_one(name, snapshot):
+        logger.info("Dumping %s to %s.", name, paths[name])
+        mode = "w" if format == "tsv" else "wb"
+        with open(paths[name], mode) as handle:
+            tables[name](engine).dump_file(
+                handle,
+                batch_size=batch_size,
+                format=format,
+                snapshot=snapshot
+            )
+        return
+
+    with export_snapshot(engine) as snapshot:
+        # Threads are enough, the workers mostly wait on the database.
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            futures = [
+                executor.submit(dump_one, name, snapshot)
+                for name in tables
+            ]
+
+            # Raise the first error, if any.
+            for future in futures:
+                future.result()
+
+    return paths
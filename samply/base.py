@@ -1,49 +1,1400 @@
 """
 """
 
+import enum
+import json
+import logging
+from datetime import datetime
+from collections import Counter
+from collections import defaultdict
+from collections import deque
+
 import pandas as pd
+from sqlalchemy import bindparam
+from sqlalchemy import func
+from sqlalchemy import Index
+from sqlalchemy import inspect
+from sqlalchemy import literal
+from sqlalchemy import select
+from sqlalchemy import text
+from sqlalchemy import Text
+from sqlalchemy import true
+from sqlalchemy import tuple_
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import selectinload
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 
 from samply import utils
+from samply import pgcopy
+from samply import backup
+from samply import columnar
+from samply import filters
 from samply import database as db
 
+logger = logging.getLogger(__name__)
+
+# The number of rows sent with each executemany.
+INSERT_BATCH_SIZE = 10000
+
+# The number of rows fetched and written at a time when dumping.
+DUMP_BATCH_SIZE = 10000
+
+# The number of names resolved with each query.
+RESOLVE_BATCH_SIZE = 5000
+
+# How samply add treats rows that are already in the database.
+# insert -- Add everything, conflicts are errors.
+# upsert -- Update rows with the same natural key, add the rest.
+# sync -- As for upsert, then delete rows that weren't in the input.
+MODES = ("insert", "upsert", "sync")
+
+
+def insert_rows(session, table, rows, batch_size=INSERT_BATCH_SIZE):
+    """ Insert dicts into a Core table with batched executemany calls. """
+    for i in range(0, len(rows), batch_size):
+        session.execute(table.insert(), rows[i:i + batch_size])
+    return
+
+
+def upsert_rows(session, table, rows, key, batch_size=INSERT_BATCH_SIZE):
+    """ Insert dicts into a Core table, updating rows that conflict.
+
+    The key columns must have a unique index.
+    Rows with only key columns are left alone if they exist.
+    """
+
+    if len(rows) == 0:
+        return
+
+    statement = pg_insert(table)
+    columns = [c for c in rows[0] if c not in key]
+    if len(columns) == 0:
+        statement = statement.on_conflict_do_nothing(index_elements=key)
+    else:
+        statement = statement.on_conflict_do_update(
+            index_elements=key,
+            set_={c: statement.excluded[c] for c in columns}
+        )
+
+    for i in range(0, len(rows), batch_size):
+        session.execute(statement, rows[i:i + batch_size])
+    return
+
+
+def write_frames(frames, handle, types, format="tsv"):
+    """ Write DataFrames one after another as a single file. """
+    if format == "tsv":
+        for i, table in enumerate(frames):
+            table.to_csv(handle, index=False, sep="\t", header=(i == 0))
+    else:
+        columnar.write_batches(frames, handle, types, format)
+    return
+
+
+def key_value(value):
+    """ Compare enums from the input and database by name. """
+    if isinstance(value, enum.Enum):
+        return value.name
+    else:
+        return value
+
+
+def key_condition(columns, keys):
+    """ A where clause matching any of the key tuples. """
+    if len(columns) == 1:
+        return columns[0].in_([k for k, in keys])
+    else:
+        return tuple_(*columns).in_(keys)
+
+
+class KeyResolver(object):
+
+    """
+    Resolves the natural keys used in input files to foreign keys, using
+    one query per batch rather than one per row.
+    Keys that can't be found are collected so that they can all be
+    reported together.
+    """
+
+    def __init__(self, column, key, value=None):
+        """
+        Keyword arguments:
+        column -- The name of the column in the table being loaded.
+        key -- The model column to look the input values up in.
+        value -- The model column holding the value to store.
+            Default = the key itself, i.e. just check that it exists.
+        """
+        self.column = column
+        self.key = key
+        self.value = key if value is None else value
+        self.missing = set()
+        self.ambiguous = set()
+        return
+
+    def resolve(self, session, keys):
+        keys = set(keys)
+        found = {}
+
+        for batch in utils.batched(keys, INSERT_BATCH_SIZE):
+            query = (
+                session.query(self.key, self.value)
+                .filter(self.key.in_(batch))
+            )
+            for key, value in query:
+                if key in found and found[key] != value:
+                    self.ambiguous.add(key)
+                found[key] = value
+
+        for key in self.ambiguous:
+            found.pop(key, None)
+
+        self.missing.update(keys.difference(found, self.ambiguous))
+        return found
+
 
 class SamplyBase(object):
 
-    def __init__(self, engine):
+    # Tables that form a tree or graph name their key column, and override
+    # _parents, so that records can be held back until their parents exist.
+    key = None
+
+    # Tables referring to other tables by natural keys map each input field
+    # to the arguments of a KeyResolver.
+    references = {}
+
+    # The columns identifying a row for upserts and syncs.
+    # Default = the primary key.
+    natural_key = None
+
+    # The relationships that _to_series reads, loaded up front by dump.
+    eager = ()
+
+    # The types of dump columns for columnar formats, see samply.columnar.
+    dump_types = {}
+
+    # The name of the geometry column used by spatial filters, if any.
+    geometry = None
+
+    # The name of the date range column used by temporal filters, if any.
+    temporal = None
+
+    # The child_id/parent_id table between rows of this table, if any.
+    adjacency = None
+
+    def __init__(self, engine, bulk=False, mode="insert"):
+        if mode not in MODES:
+            raise ValueError("Mode must be one of {}.".format(
+                ", ".join(MODES)))
+        elif mode != "insert" and engine.dialect.name != "postgresql":
+            raise ValueError("Upserts are only supported for postgres.")
+
         self.engine = engine
+        self.mode = mode
+        self.seen = set()
+        self.counts = Counter()
+        self.pending = []
+        self.resolvers = {
+            field: KeyResolver(*args)
+            for field, args
+            in self.references.items()
+        }
+
+        self.bulk = bulk and pgcopy.available(engine)
+        if bulk and not self.bulk:
+            logger.info("Bulk loading isn't available, using the ORM.")
+
+        self.columns_checked = False
         return
 
     def get_session(self):
         return db.session_scope(self.engine)
 
-    def dump(self):
+    def dump(self, where=None):
+        """ Dump the table, or the rows matching the filters, to a DataFrame.
+
+        where is a list of filter strings (see samply.filters) or
+        SQLAlchemy expressions, e.g. ["date>=2019-01-01", samples.bbox(...)].
+        """
+        frames = list(self.dump_batches(where=where))
+        return pd.concat(frames, ignore_index=True)
+
+    def dump_batches(self, batch_size=DUMP_BATCH_SIZE, snapshot=None,
+                     where=None):
+        """ Yield the table as DataFrames of up to batch_size rows.
+
+        Records are streamed from a server side cursor, so memory use
+        depends on the batch size rather than the table size.
+        If snapshot is given, rows are read from that exported postgres
+        snapshot (see samply.backup). where filters the rows in SQL.
+        """
+
+        self._check_columns()
+        clauses = filters.compile_filters(self._filter_columns(), where)
+
+        with self.get_session() as session:
+            if snapshot is not None:
+                backup.use_snapshot(session, snapshot)
+
+            query = self._dump_query(session).filter(*clauses)
+            query = query.yield_per(batch_size)
+
+            empty = True
+            for batch in utils.batched(query, batch_size):
+                yield self._to_frame(batch)
+                empty = False
+
+            if empty:
+                yield self._to_frame([])
+        return
+
+    def _dump_query(self, session):
+        return session.query(self.table).options(*self._eager_options())
+
+    def _missing_columns(self):
+        """ The table's columns that don't exist in the database. """
+        table = self.table.__table__
+        existing = {
+            c["name"]
+            for c in inspect(self.engine).get_columns(table.name)
+        }
+        return [c for c in table.columns if c.name not in existing]
+
+    def _check_columns(self):
+        """ Raise an error if the table predates its date range column.
+
+        Only checked once per instance. `samply migrate` adds the column.
+        """
+
+        if self.columns_checked or self.temporal is None:
+            return
+
+        missing = [c.name for c in self._missing_columns()]
+        if self.temporal in missing:
+            raise ValueError(
+                "The {} table has no {} column, it was created by an older "
+                "version of samply. Add it with `samply migrate`.".format(
+                    self.table.__tablename__, self.temporal))
+
+        self.columns_checked = True
+        return
+
+    def migrate(self):
+        """ Add the date range column to tables created before it existed.
+
+        The ranges are filled in from the dates and their resolutions in a
+        single UPDATE, and the column's index is created.
+        """
+
+        if self.temporal is None:
+            return
+
+        table = self.table.__table__
+        column = table.c[self.temporal]
+        if column not in self._missing_columns():
+            return
+        elif self.engine.dialect.name != "postgresql":
+            raise ValueError(
+                "Can only add the {} column to {} on postgres. Recreate the "
+                "database with `samply init`.".format(column.name, table.name))
+
+        logger.info("Adding the %s column to %s.", column.name, table.name)
+        preparer = self.engine.dialect.identifier_preparer
+        with self.get_session() as session:
+            session.execute(text("ALTER TABLE {} ADD COLUMN {} {}".format(
+                preparer.format_table(table),
+                preparer.quote(column.name),
+                column.type.compile(dialect=self.engine.dialect)
+            )))
+            session.execute(
+                table.update()
+                .where(table.c.date.isnot(None))
+                .where(table.c.date_resolution.isnot(None))
+                .values({
+                    column.name: utils.date_range_expression(
+                        table.c.date, table.c.date_resolution)
+                })
+            )
+
+        for index in table.indexes:
+            if column in index.columns.values():
+                index.create(self.engine, checkfirst=True)
+        return
+
+    def _filter_columns(self):
+        """ The expressions that filter strings can refer to, by name. """
+        return dict(self.table.__table__.c.items())
+
+    def lineage(self, key, up=True, depth=None):
+        """ Walk the parents (up) or children (down) of a row.
+
+        The whole subgraph is found with one recursive query over the
+        adjacency table, rather than one lazy load per generation.
+
+        Keyword arguments:
+        key -- The key of the row to start from, e.g. a sample id.
+        up -- Find ancestors if True, otherwise descendants.
+        depth -- The number of generations to walk. Default = all.
+
+        Returns:
+        A DataFrame of the related rows' keys with the generation that
+        they were first reached at, and a DataFrame of the edges between
+        them as child and parent keys.
+        """
+
+        if self.adjacency is None:
+            raise ValueError("{} has no hierarchy.".format(
+                self.table.__tablename__))
+
+        table = self.table.__table__
+        label = table.c[self.key]
+        adjacency = self.adjacency
+
+        def ends(adjacency):
+            # The end of an edge to walk from, and the end to walk to.
+            if up:
+                return adjacency.c.child_id, adjacency.c.parent_id
+            else:
+                return adjacency.c.parent_id, adjacency.c.child_id
+
+        start = select(table.c.id).where(label == key).scalar_subquery()
+        near, far = ends(adjacency)
+        walk = select(
+            adjacency.c.child_id,
+            adjacency.c.parent_id,
+            literal(1).label("generation"),
+        ).where(near == start).cte("walk", recursive=True)
+
+        step = adjacency.alias("step")
+        step_near, _ = ends(step)
+        walk_far = walk.c.parent_id if up else walk.c.child_id
+        recurse = (
+            select(
+                step.c.child_id,
+                step.c.parent_id,
+                walk.c.generation + 1,
+            )
+            .join_from(walk, step, step_near == walk_far)
+        )
+        if depth is not None:
+            recurse = recurse.where(walk.c.generation < depth)
+
+        walk = walk.union(recurse)
+
+        child = table.alias("child")
+        parent = table.alias("parent")
+        generation = func.min(walk.c.generation)
+        query = (
+            select(
+                child.c[self.key].label("child"),
+                parent.c[self.key].label("parent"),
+                generation.label("generation"),
+            )
+            .join_from(walk, child, child.c.id == walk.c.child_id)
+            .join(parent, parent.c.id == walk.c.parent_id)
+            .group_by(child.c[self.key], parent.c[self.key])
+            .order_by(generation, child.c[self.key], parent.c[self.key])
+        )
+
         with self.get_session() as session:
-            records = session.query(self.table).all()
-            rows = [self._to_series(r) for r in records]
+            rows = session.execute(query).all()
+
+            if len(rows) == 0:
+                exists = session.execute(
+                    select(label).where(label == key)).first()
+                if exists is None:
+                    raise ValueError("{} {} doesn't exist.".format(
+                        self.table.__tablename__, key))
+
+        edges = pd.DataFrame.from_records(
+            rows,
+            columns=["child", "parent", "generation"]
+        )
+
+        generations = {key: 0}
+        for child_key, parent_key, gen in rows:
+            node = parent_key if up else child_key
+            generations[node] = min(gen, generations.get(node, gen))
+
+        nodes = pd.DataFrame({
+            self.key: list(generations.keys()),
+            "generation": list(generations.values()),
+        })
+        return nodes, edges
+
+    def _geometry(self):
+        if self.geometry is None:
+            raise ValueError("{} has no geometry to filter on.".format(
+                self.table.__tablename__))
+        return getattr(self.table, self.geometry)
+
+    def spatial_index(self):
+        """ Make sure that the geometry column has GiST indexes, on the
+        geometry for filters and on its geography for nearest.
+
+        The name of the first matches the index that geoalchemy2 creates
+        with the table, so it's only made for databases created without one.
+        """
+
+        if self.engine.dialect.name != "postgresql":
+            return
+
+        column = self._geometry()
+        name = "idx_{}_{}".format(self.table.__tablename__, self.geometry)
+        indices = [
+            Index(name, column, postgresql_using="gist"),
+            Index(name + "_geography", filters.geography(column),
+                  postgresql_using="gist"),
+        ]
+        for index in indices:
+            index.create(self.engine, checkfirst=True)
+        return
+
+    def _temporal(self):
+        if self.temporal is None:
+            raise ValueError("{} has no dates to filter on.".format(
+                self.table.__tablename__))
+        return getattr(self.table, self.temporal)
+
+    def overlapping(self, start, end):
+        """ A filter for rows whose dates could be in a [start, end) window.
+
+        E.g. a sample dated 2020 at year resolution overlaps March 2020.
+        """
+        return filters.overlaps(self._temporal(), start, end)
+
+    def during(self, start, end):
+        """ A filter for rows whose dates are certainly in a window. """
+        return filters.during(self._temporal(), start, end)
+
+    def bbox(self, xmin, ymin, xmax, ymax):
+        """ A filter for rows intersecting a lon/lat bounding box. """
+        return filters.bbox(self._geometry(), xmin, ymin, xmax, ymax)
+
+    def contains(self, lon, lat):
+        """ A filter for rows whose geometry contains a lon/lat point. """
+        return filters.contains_point(self._geometry(), lon, lat)
+
+    def within(self, lon, lat, metres):
+        """ A filter for rows within a distance of a lon/lat point. """
+        return filters.within_distance(self._geometry(), lon, lat, metres)
+
+    def nearest(self, lon, lat, n=10, where=None):
+        """ The n rows nearest to a lon/lat point, closest first.
+
+        Returns the dump columns with the distance in metres on the sphere.
+        The ordering uses the <-> operator on geographies, so it's answered
+        from the geography GiST index, and is by the same distance.
+        Only for tables whose dump query selects columns (e.g. Samples).
+        """
+
+        self.spatial_index()
+
+        column = self._geometry()
+        self._check_columns()
+        clauses = filters.compile_filters(self._filter_columns(), where)
+        distance = filters.knn_distance(column, lon, lat)
+
+        with self.get_session() as session:
+            rows = (
+                self._dump_query(session)
+                .add_columns(distance)
+                .filter(*clauses)
+                .order_by(distance)
+                .limit(n)
+                .all()
+            )
+
+        frame = self._to_frame([r[:-1] for r in rows])
+        frame["distance"] = [r[-1] for r in rows]
+        return frame
+
+    def _to_frame(self, records):
+        """ Convert a batch of results from _dump_query to a DataFrame. """
+        return pd.DataFrame.from_records([self._to_series(r) for r in records])
 
-        return pd.DataFrame.from_records(rows)
+    def _eager_options(self):
+        """ Load collections with one extra query per batch, and single
+        related rows with a join, rather than one query per record.
+        """
+
+        options = []
+        for name in self.eager:
+            attribute = getattr(self.table, name)
+            if attribute.property.uselist:
+                options.append(selectinload(attribute))
+            else:
+                options.append(joinedload(attribute))
+        return options
+
+    def dump_file(self, handle, batch_size=DUMP_BATCH_SIZE, format="tsv",
+                  snapshot=None, where=None):
+        """ Write the table one batch at a time.
+
+        TSV needs a text handle. Parquet and arrow need a path or a binary
+        handle, and write one row group or record batch per batch.
+        """
+
+        batches = self.dump_batches(batch_size, snapshot=snapshot,
+                                    where=where)
+        write_frames(batches, handle, self.dump_types, format)
+        return
 
     def add_record(self, **kwargs):
         record = self.table(**kwargs)
         with self.get_session() as session:
             session.add(record)
 
-    def add_records(self, records):
+    def add_records(self, records, final=True):
+        """ Add records to the database in one transaction.
+
+        If final is False, records whose parents don't exist yet are held
+        back for the next call instead of raising an error.
+        """
+
+        self._check_columns()
         with self.get_session() as session:
-            session.add_all((self.table(**r) for r in records))
+            self._add_records(session, records, final=final)
+
+            if final and self.mode == "sync":
+                # In the same transaction, so a sync is applied in full
+                # or not at all.
+                self._delete_unseen(session)
+
+        if final and self._changed():
+            self._after_load()
+        return
+
+    def _changed(self):
+        """ Whether any rows have been inserted, updated or deleted. """
+        return any(
+            self.counts[c] > 0
+            for c in ("inserted", "updated", "deleted")
+        )
 
-    def add_file(self, path):
-        table = pd.read_table(path)
-        self.add_table(table)
+    def _after_load(self):
+        """ Called once all records have been added if any rows changed,
+        e.g. to rebuild derived tables. Rebuilds the name index by default.
+        """
+        self.rebuild_names()
         return
 
+    def _name_query(self):
+        """ A select of (key, name) pairs to resolve names against.
+
+        None if rows of this table can't be looked up by name.
+        """
+        return None
+
+    def rebuild_names(self):
+        """ Rebuild the rows of the name index for this table. """
+
+        names = self._name_query()
+        if names is None:
+            return
+        elif self.engine.dialect.name != "postgresql":
+            logger.debug("Name indexes are only supported for postgres.")
+            return
+
+        index = db.NameIndex.__table__
+        index.create(self.engine, checkfirst=True)
+        table_name = self.table.__tablename__
+
+        names = names.subquery()
+        pairs = select(
+            literal(table_name),
+            func.lower(func.trim(names.c.name)),
+            names.c.key,
+            func.min(names.c.name),
+        ).where(names.c.name.isnot(None)).group_by(
+            func.lower(func.trim(names.c.name)),
+            names.c.key,
+        )
+
+        with self.get_session() as session:
+            session.execute(
+                index.delete().where(index.c.table_name == table_name))
+            session.execute(index.insert().from_select(
+                ["table_name", "normalised", "key", "name"],
+                pairs
+            ))
+        return
+
+    def resolve(self, names, min_score=0.3, batch_size=RESOLVE_BATCH_SIZE):
+        """ Find the best matching row for each of a list of names.
+
+        Names are matched case insensitively against the name index by
+        trigram similarity, using its GIN index, so exact matches score 1.
+        Each batch of names is resolved in a single query.
+
+        Returns:
+        A DataFrame with the query name, and the key, name and score of the
+        best match, or nulls if nothing scored at least min_score.
+        """
+
+        if self._name_query() is None:
+            raise ValueError("{} can't be resolved by name.".format(
+                self.table.__tablename__))
+        elif self.engine.dialect.name != "postgresql":
+            raise ValueError("Resolving names is only supported for postgres.")
+
+        index = db.NameIndex.__table__
+        table_name = self.table.__tablename__
+
+        queries = (
+            func.unnest(bindparam("names", type_=ARRAY(Text)))
+            .table_valued("query", with_ordinality="position")
+            .render_derived()
+        )
+        wanted = func.lower(func.trim(queries.c.query))
+        score = func.similarity(index.c.normalised, wanted)
+        best = (
+            select(
+                index.c.key,
+                index.c.name,
+                score.label("score"),
+            )
+            .where(index.c.table_name == table_name)
+            .where(index.c.normalised.op("%")(wanted))
+            .order_by(score.desc(), index.c.key)
+            .limit(1)
+            .lateral("best")
+        )
+        query = (
+            select(queries.c.query, best.c.key, best.c.name, best.c.score)
+            .select_from(queries)
+            .outerjoin(best, true())
+            .order_by(queries.c.position)
+        )
+
+        rows = []
+        with self.get_session() as session:
+            session.execute(
+                text("SELECT set_config('pg_trgm.similarity_threshold', "
+                     ":threshold, true)"),
+                {"threshold": str(min_score)}
+            )
+            for batch in utils.batched(names, batch_size):
+                rows.extend(session.execute(query, {"names": list(batch)}))
+
+        return pd.DataFrame.from_records(
+            rows,
+            columns=["query", "key", "name", "score"]
+        )
+
+    def _add_records(self, session, records, final=True):
+        if self.key is not None:
+            records = self._hold_orphans(session, records)
+            records = self._topological_order(records)
+
+        if len(self.resolvers) > 0:
+            records = self._resolve(session, records)
+
+        if self.mode != "insert":
+            self._check_duplicates(records)
+
+        if self.mode == "sync":
+            key = self._natural_key()
+            self.seen.update(
+                tuple(key_value(r[k]) for k in key)
+                for r in records
+            )
+
+        if self.mode == "insert":
+            self.counts["inserted"] += len(records)
+        else:
+            records = self._skip_unchanged(session, records)
+
+        self._write_records(session, records)
+
+        if final:
+            self._check_unresolved()
+        return
+
+    def _resolve(self, session, records):
+        """ Replace natural keys with foreign keys.
+
+        Records with keys that can't be resolved are left out, and are
+        reported by _check_unresolved.
+        """
+
+        found = {
+            field: resolver.resolve(session, {r[field] for r in records})
+            for field, resolver
+            in self.resolvers.items()
+        }
+
+        output = []
+        for record in records:
+            values = {f: found[f].get(record.pop(f)) for f in found}
+            if any(v is None for v in values.values()):
+                continue
+
+            for field, value in values.items():
+                record[self.resolvers[field].column] = value
+            output.append(record)
+        return output
+
+    def _write_rows(self, session, table, rows, key=None):
+        """ Write dicts to a Core table with COPY or executemany.
+
+        Outside of insert mode, rows that conflict on the key are updated.
+        The key defaults to the table's primary key.
+        """
+
+        if self.mode == "insert":
+            if self.bulk:
+                pgcopy.copy_rows(session.connection(), table, rows)
+            else:
+                insert_rows(session, table, rows)
+            return
+
+        if key is None:
+            key = [c.name for c in table.primary_key]
+
+        if self.bulk:
+            pgcopy.copy_upsert(session.connection(), table, rows, key)
+        else:
+            upsert_rows(session, table, rows, key)
+        return
+
+    def _write_records(self, session, records):
+        self._write_rows(
+            session,
+            self.table.__table__,
+            records,
+            key=self._natural_key()
+        )
+        return
+
+    def _natural_key(self):
+        if self.natural_key is None:
+            return [c.name for c in self.table.__table__.primary_key]
+        else:
+            return list(self.natural_key)
+
+    def _prepare_upsert(self):
+        """ Upserts need the unique indices and the row hash table, which
+        older databases lack.
+
+        Raises a ValueError listing the duplicated keys if an index can't
+        be created because of rows already in the database.
+        """
+
+        table = self.table.__table__
+        existing = {
+            index["name"]
+            for index in inspect(self.engine).get_indexes(table.name)
+        }
+
+        for index in table.indexes:
+            if not index.unique or index.name in existing:
+                continue
+
+            columns = list(index.columns)
+            with self.get_session() as session:
+                duplicates = session.execute(
+                    select(*columns)
+                    .group_by(*columns)
+                    .having(func.count() > 1)
+                    .limit(10)
+                ).all()
+
+            if len(duplicates) > 0:
+                raise ValueError(
+                    "Can't create the unique index {} that upserts need, "
+                    "these keys are duplicated: {}.".format(
+                        index.name,
+                        ", ".join(str(tuple(d)) for d in duplicates)
+                    ))
+
+            index.create(self.engine)
+
+        db.RowHash.__table__.create(self.engine, checkfirst=True)
+        return
+
+    def _check_duplicates(self, records):
+        """ Raise an error for records that share a natural key, or that
+        are missing part of it.
+
+        ON CONFLICT can't update the same row twice in one statement, and
+        never matches keys containing NULLs.
+        """
+
+        key = self._natural_key()
+        keys = [tuple(key_value(r.get(k)) for k in key) for r in records]
+
+        missing = sorted({
+            k for values in keys
+            for k, v in zip(key, values)
+            if v is None
+        })
+        if len(missing) > 0:
+            raise ValueError("Records are missing values for {}.".format(
+                ", ".join(missing)))
+
+        counts = Counter(keys)
+        duplicates = sorted(
+            str(k[0] if len(k) == 1 else k)
+            for k, n in counts.items()
+            if n > 1
+        )
+
+        if len(duplicates) > 0:
+            raise ValueError("Duplicate keys: {}".format(
+                ", ".join(duplicates)))
+        return
+
+    def _row_key(self, key):
+        return json.dumps([key_value(k) for k in key], default=str)
+
+    def _skip_unchanged(self, session, records):
+        """ Leave out records whose content hash matches the stored one.
+
+        Hashes are taken over the normalised records, and are stored for
+        the new and changed records returned.
+        """
+
+        if len(records) == 0:
+            return records
+
+        table = self.table.__table__
+        key = self._natural_key()
+        columns = [table.c[k] for k in key]
+        keys = [tuple(r[k] for k in key) for r in records]
+        row_keys = [self._row_key(k) for k in keys]
+        digests = [utils.record_digest(r) for r in records]
+
+        stored = {}
+        for batch in utils.batched(row_keys, INSERT_BATCH_SIZE):
+            stored.update(
+                session.query(db.RowHash.row_key, db.RowHash.digest)
+                .filter(db.RowHash.table_name == table.name)
+                .filter(db.RowHash.row_key.in_(batch))
+            )
+
+        existing = set()
+        for batch in utils.batched(keys, INSERT_BATCH_SIZE):
+            existing.update(
+                self._row_key(row)
+                for row
+                in session.query(*columns).filter(
+                    key_condition(columns, batch))
+            )
+
+        changed = []
+        hashes = []
+        for record, row_key, digest in zip(records, row_keys, digests):
+            if stored.get(row_key) == digest:
+                self.counts["unchanged"] += 1
+                continue
+            elif row_key in existing:
+                self.counts["updated"] += 1
+            else:
+                self.counts["inserted"] += 1
+
+            changed.append(record)
+            hashes.append({
+                "table_name": table.name,
+                "row_key": row_key,
+                "digest": digest,
+            })
+
+        if self.bulk:
+            pgcopy.copy_upsert(session.connection(), db.RowHash.__table__,
+                               hashes, ["table_name", "row_key"])
+        else:
+            upsert_rows(session, db.RowHash.__table__, hashes,
+                        ["table_name", "row_key"])
+        return changed
+
+    def _delete_keys(self, session, keys):
+        """ Delete rows, and their hashes, by natural key. """
+
+        table = self.table.__table__
+        columns = [table.c[k] for k in self._natural_key()]
+
+        for i in range(0, len(keys), INSERT_BATCH_SIZE):
+            batch = keys[i:i + INSERT_BATCH_SIZE]
+            session.execute(
+                table.delete().where(key_condition(columns, batch)))
+            session.query(db.RowHash).filter(
+                db.RowHash.table_name == table.name,
+                db.RowHash.row_key.in_([self._row_key(k) for k in batch])
+            ).delete(synchronize_session=False)
+
+        self.counts["deleted"] += len(keys)
+        return
+
+    def _referencing_columns(self):
+        """ The foreign key columns of other tables pointing at this one,
+        with the columns that they refer to.
+
+        The adjacency table is left out, its edges are deleted with the rows.
+        """
+        table = self.table.__table__
+        return [
+            (fk.parent, fk.column)
+            for other in db.Base.metadata.sorted_tables
+            if other is not self.adjacency
+            for fk in other.foreign_keys
+            if fk.column.table is table
+        ]
+
+    def _check_references(self, session, keys, kept=False):
+        """ Raise an error if other rows still refer to rows being deleted.
+
+        Rows that are being deleted themselves, e.g. the children of deleted
+        taxa, don't count. Nothing is deleted if any are found.
+        kept says that the rows added by the load have already been
+        committed, e.g. by a chunked load, for the error message.
+        """
+
+        table = self.table.__table__
+        columns = [table.c[k] for k in self._natural_key()]
+
+        problems = []
+        for column, referenced in self._referencing_columns():
+            found = {}
+            for batch in utils.batched(keys, INSERT_BATCH_SIZE):
+                query = select(referenced, *columns).where(
+                    key_condition(columns, batch))
+                for value, *key in session.execute(query):
+                    found[value] = tuple(key)
+
+            if column.table is table:
+                own = table.c[referenced.name]
+            else:
+                own = literal(None)
+
+            referred = set()
+            for batch in utils.batched(found, INSERT_BATCH_SIZE):
+                query = (
+                    select(column, own)
+                    .distinct()
+                    .where(column.in_(batch))
+                )
+                referred.update(
+                    value for value, this in session.execute(query)
+                    if this not in found
+                )
+
+            if len(referred) > 0:
+                examples = sorted(str(found[v][0]) for v in referred)
+                problems.append("{}.{} refers to {} of them: {}".format(
+                    column.table.name,
+                    column.name,
+                    len(referred),
+                    ", ".join(examples[:10]) +
+                    (", ..." if len(examples) > 10 else "")
+                ))
+
+        if len(problems) > 0:
+            if kept:
+                outcome = ("The rows that were added or updated have been "
+                           "kept, but nothing was deleted.")
+            else:
+                outcome = "Nothing was changed."
+
+            raise ValueError(
+                "Can't delete the {} rows that weren't in the input, {}. "
+                "Remove those references first, e.g. by syncing the tables "
+                "that refer to them. {}".format(
+                    table.name, "; ".join(problems), outcome))
+        return
+
+    def _delete_unseen(self, session, kept=False):
+        """ Delete rows whose natural keys weren't in the input.
+
+        kept says whether the rows added by this load are already committed.
+        """
+
+        table = self.table.__table__
+        columns = [table.c[k] for k in self._natural_key()]
+
+        existing = {
+            tuple(key_value(v) for v in row)
+            for row in session.query(*columns)
+        }
+
+        # Older databases allowed NULLs in keys, which can't be matched.
+        incomplete = {k for k in existing if None in k}
+        if len(incomplete) > 0:
+            logger.warning(
+                "Leaving %s rows with incomplete keys, they can't be "
+                "matched to the input.", len(incomplete))
+
+        unseen = sorted(existing.difference(self.seen, incomplete), key=str)
+
+        self._check_references(session, unseen, kept=kept)
+        logger.info("Deleting %s rows that weren't in the input.",
+                    len(unseen))
+        self._delete_keys(session, unseen)
+        return
+
+    @staticmethod
+    def _parents(record):
+        """ The keys of the records that this record refers to. """
+        return []
+
+    def _hold_orphans(self, session, records):
+        """ Hold back records whose parents haven't been added yet.
+
+        Records held from previous calls are tried again first.
+        Records whose parents are in the database or in this batch are
+        returned, the rest are kept in self.pending.
+        """
+
+        records = self.pending + records
+        keys = {r[self.key] for r in records}
+
+        outside = {
+            p
+            for r in records
+            for p in self._parents(r)
+            if p not in keys
+        }
+
+        column = getattr(self.table, self.key)
+        existing = set()
+        for batch in utils.batched(outside, INSERT_BATCH_SIZE):
+            existing.update(
+                k for k, in
+                session.query(column).filter(column.in_(batch))
+            )
+
+        children = defaultdict(list)
+        queue = []
+        for record in records:
+            parents = self._parents(record)
+            for parent in parents:
+                children[parent].append(record)
+
+            if any(p in outside and p not in existing for p in parents):
+                queue.append(record)
+
+        # Anything descending from a held record must also wait.
+        held = set()
+        while len(queue) > 0:
+            record = queue.pop()
+            if record[self.key] in held:
+                continue
+            held.add(record[self.key])
+            queue.extend(children[record[self.key]])
+
+        self.pending = [r for r in records if r[self.key] in held]
+        if len(self.pending) > 0:
+            logger.info("Holding %s records until their parents are added.",
+                        len(self.pending))
+        return [r for r in records if r[self.key] not in held]
+
+    def _topological_order(self, records):
+        """ Order records so that parents always come before children.
+
+        Parents outside of the batch are assumed to exist already.
+        This is iterative, so deep trees don't hit the recursion limit.
+        Raises a ValueError for duplicate keys or cycles.
+        """
+
+        keys = {r[self.key] for r in records}
+        if len(keys) < len(records):
+            seen = set()
+            duplicates = set()
+            for record in records:
+                if record[self.key] in seen:
+                    duplicates.add(str(record[self.key]))
+                seen.add(record[self.key])
+
+            raise ValueError("Duplicate keys: {}".format(
+                ", ".join(sorted(duplicates))))
+
+        children = defaultdict(list)
+        waiting = {}
+        queue = deque()
+        for record in records:
+            parents = {p for p in self._parents(record) if p in keys}
+            waiting[record[self.key]] = len(parents)
+
+            for parent in parents:
+                children[parent].append(record)
+
+            if len(parents) == 0:
+                queue.append(record)
+
+        order = []
+        while len(queue) > 0:
+            record = queue.popleft()
+            order.append(record)
+
+            for child in children[record[self.key]]:
+                waiting[child[self.key]] -= 1
+                if waiting[child[self.key]] == 0:
+                    queue.append(child)
+
+        if len(order) < len(records):
+            cycle = sorted(str(k) for k, n in waiting.items() if n > 0)
+            raise ValueError("Records form a cycle: {}".format(
+                ", ".join(cycle)))
+        return order
+
+    def _unresolved(self):
+        """ Whether any keys couldn't be resolved so far. """
+        return any(
+            len(r.missing) > 0 or len(r.ambiguous) > 0
+            for r in self.resolvers.values()
+        )
+
+    def _check_unresolved(self):
+        """ Raise an error listing everything that couldn't be found. """
+
+        problems = []
+        if len(self.pending) > 0:
+            held = {r[self.key] for r in self.pending}
+            keys = sorted({
+                str(p)
+                for r in self.pending
+                for p in self._parents(r)
+                if p not in held
+            })
+            problems.append("missing parents: {}".format(", ".join(keys)))
+
+        for field, resolver in self.resolvers.items():
+            if len(resolver.missing) > 0:
+                problems.append("{} not found: {}".format(
+                    field,
+                    ", ".join(sorted(str(k) for k in resolver.missing))
+                ))
+
+            if len(resolver.ambiguous) > 0:
+                problems.append("{} matches several rows: {}".format(
+                    field,
+                    ", ".join(sorted(str(k) for k in resolver.ambiguous))
+                ))
+
+        if len(problems) > 0:
+            raise ValueError("Couldn't add records, {}.".format(
+                "; ".join(problems)))
+        return
+
+    def _drop_existing(self, session, records):
+        """ Remove records whose keys are already in the database. """
+
+        if self.key is None:
+            return records
+
+        column = getattr(self.table, self.key)
+        keys = [r[self.key] for r in records]
+        existing = set()
+        for batch in utils.batched(keys, INSERT_BATCH_SIZE):
+            existing.update(
+                k for k, in
+                session.query(column).filter(column.in_(batch))
+            )
+        return [r for r in records if r[self.key] not in existing]
+
+    def _get_checkpoint(self, path, resume=False):
+        """ Find or start the checkpoint for loading this file.
+
+        Returns None if the file can't be identified, e.g. stdin.
+        """
+
+        digest = utils.file_digest(path)
+        if digest is None:
+            if resume:
+                raise ValueError("Can only resume loads from named files.")
+            return None
+
+        db.LoadCheckpoint.__table__.create(self.engine, checkfirst=True)
+        table_name = self.table.__tablename__
+
+        with self.get_session() as session:
+            checkpoint = session.query(db.LoadCheckpoint).filter(
+                db.LoadCheckpoint.table_name == table_name,
+                db.LoadCheckpoint.file_digest == digest,
+            ).one_or_none()
+
+            if checkpoint is None:
+                checkpoint = db.LoadCheckpoint(
+                    table_name=table_name,
+                    file_digest=digest
+                )
+                session.add(checkpoint)
+
+            if not resume or checkpoint.start is None:
+                checkpoint.start = 0
+                checkpoint.rows = 0
+                checkpoint.finished = False
+            elif checkpoint.finished:
+                logger.info("This file has already been added.")
+            else:
+                logger.info("Resuming from row %s.", checkpoint.start)
+
+            checkpoint.updated = datetime.now()
+            session.flush()
+            return {
+                "id": checkpoint.id,
+                "start": checkpoint.start,
+                "rows": checkpoint.rows,
+                "finished": checkpoint.finished,
+            }
+
+    @staticmethod
+    def _save_checkpoint(session, checkpoint):
+        session.query(db.LoadCheckpoint).filter(
+            db.LoadCheckpoint.id == checkpoint["id"]
+        ).update({
+            "start": checkpoint["start"],
+            "rows": checkpoint["rows"],
+            "finished": checkpoint["finished"],
+            "updated": datetime.now(),
+        })
+        return
+
+    @staticmethod
+    def _read_table(path, format):
+        if format == "tsv":
+            return pd.read_table(path)
+        return columnar.read_table(path, format)
+
+    @staticmethod
+    def _read_batches(path, format, chunksize, skip):
+        if format == "tsv":
+            return pd.read_table(
+                path,
+                chunksize=chunksize,
+                skiprows=range(1, skip + 1)
+            )
+        return columnar.read_batches(path, format, chunksize, skip)
+
+    def add_file(self, path, chunksize=None, resume=False, format=None):
+        """ Add a table from a file.
+
+        The format is one of "tsv", "parquet" or "arrow", and is guessed
+        from the file suffix if not given. Typed columns in parquet and
+        arrow files (dates, lists and dictionaries) are used as they are.
+
+        If chunksize is given the file is read, converted and committed
+        that many rows at a time, so memory is bounded by the chunk size.
+        Progress is recorded with each commit, so that a failed load can be
+        continued with resume=True.
+        """
+
+        if format is None:
+            format = columnar.input_format(path)
+
+        self._check_columns()
+        if self.mode != "insert":
+            self._prepare_upsert()
+
+        if chunksize is None:
+            if resume:
+                raise ValueError("Only chunked loads can be resumed.")
+
+            table = self._read_table(path, format)
+            self.add_table(table)
+            return self._report()
+
+        checkpoint = self._get_checkpoint(path, resume)
+        if checkpoint is None:
+            checkpoint = {"start": 0, "rows": 0, "finished": False}
+        elif checkpoint["finished"]:
+            return self._report()
+
+        if self.mode == "sync" and checkpoint["rows"] > 0:
+            raise ValueError(
+                "Sync loads can't be resumed, the keys added before "
+                "the failure are unknown."
+            )
+
+        reader = self._read_batches(
+            path,
+            format,
+            chunksize,
+            checkpoint["start"]
+        )
+
+        end = checkpoint["start"]
+        unresolved = False
+        for table in reader:
+            start = end
+            end += len(table)
+
+            records = self._from_frame(table)
+            with self.get_session() as session:
+                if unresolved:
+                    # Nothing more is added, but the rest of the file is
+                    # checked so that every missing key is reported.
+                    self._resolve(session, records)
+                    continue
+
+                logger.info("Adding rows %s to %s.", start, end)
+
+                # Some of these may have been committed before a failure.
+                if start < checkpoint["rows"]:
+                    records = self._drop_existing(session, records)
+
+                self._add_records(session, records, final=False)
+
+                if self._unresolved():
+                    # The checkpoint stays before this chunk, so resuming
+                    # retries the rows that couldn't be resolved.
+                    logger.info("Rows %s to %s refer to keys that weren't "
+                                "found, stopping.", start, end)
+                    session.rollback()
+                    unresolved = True
+                    continue
+
+                # Held records mean earlier rows aren't all committed yet.
+                if len(self.pending) == 0:
+                    checkpoint["start"] = end
+                checkpoint["rows"] = max(end, checkpoint["rows"])
+
+                if "id" in checkpoint:
+                    self._save_checkpoint(session, checkpoint)
+
+        self._check_unresolved()
+
+        if self.mode == "sync":
+            with self.get_session() as session:
+                self._delete_unseen(session, kept=True)
+
+        if self._changed():
+            self._after_load()
+
+        if "id" in checkpoint:
+            checkpoint["finished"] = True
+            with self.get_session() as session:
+                self._save_checkpoint(session, checkpoint)
+        return self._report()
+
+    def _report(self):
+        """ Log and return the counts of rows written. """
+        logger.info(
+            "Inserted %s, updated %s, unchanged %s and deleted %s rows.",
+            self.counts["inserted"],
+            self.counts["updated"],
+            self.counts["unchanged"],
+            self.counts["deleted"],
+        )
+        return dict(self.counts)
+
     def add_table(self, table):
+        records = self._from_frame(table)
+        self.add_records(records)
+        return
+
+    @classmethod
+    def _from_frame(cls, table):
+        """ Convert a whole table to a list of records.
+
+        Subclasses override this with a column-wise version of
+        `_from_series`, this row by row version is only a fallback.
+        """
         records = []
 
         for i, loc in table.iterrows():
-            this_loc = self._from_series(loc)
+            this_loc = cls._from_series(loc)
             this_loc = utils.tidy_nans(this_loc)
             records.append(this_loc)
 
-        self.add_records(records)
-        return
+        return records
@@ -1,11 +1,13 @@
 """ Command line interface """
 
 import os
-import sys
 import argparse
 import logging
 
 from samply import utils
+from samply.base import MODES
+from samply.base import DUMP_BATCH_SIZE
+from samply.columnar import FORMATS
 from samply import __version__
 
 logger = logging.getLogger("cli")
@@ -13,6 +15,16 @@ logger = logging.getLogger("cli")
 TABLES = ["contributors", "contr", "taxon", "samples", "pesticides",
           "sampletaxon", "samplepesticides", "samplecontribution"]
 
+VIEWS = ["wide", "sampletaxon-lineage"]
+
+SPATIAL_COORDS = {
+    "contains": ("LON", "LAT"),
+    "within": ("LON", "LAT", "KM"),
+    "bbox": ("XMIN", "YMIN", "XMAX", "YMAX"),
+    "nearest": ("LON", "LAT"),
+    "index": (),
+}
+
 
 @utils.log(logger, logging.DEBUG)
 def cli(prog, args):
@@ -66,9 +78,69 @@ def cli(prog, args):
 
     subparsers = parser.add_subparsers(help="subcommand help", dest="command")
     _ = cli_init(subparsers)
+    _ = cli_migrate(subparsers)
     _ = cli_add(subparsers)
     _ = cli_dump(subparsers)
-    return parser.parse_args(args)
+    _ = cli_export(subparsers)
+    _ = cli_taxon(subparsers)
+    _ = cli_lineage(subparsers)
+    _ = cli_spatial(subparsers)
+    _ = cli_resolve(subparsers)
+    _ = cli_index(subparsers)
+    parsed = parser.parse_args(args)
+
+    if (parsed.command == "add" and parsed.resume and
+            parsed.chunk_size is None):
+        parser.error("--resume requires --chunk-size")
+
+    if parsed.command == "add" and parsed.resume and parsed.mode == "sync":
+        parser.error("sync loads can't be resumed")
+
+    if (parsed.command == "add" and parsed.server_buffer and
+            parsed.table != "samples"):
+        parser.error("--server-buffer only applies to samples")
+
+    if parsed.command == "dump":
+        if parsed.all and parsed.table is not None:
+            parser.error("give either a table or --all, not both")
+        elif parsed.all and parsed.outdir is None:
+            parser.error("--all requires --outdir")
+        elif not parsed.all and parsed.table is None:
+            parser.error("a table or --all is required")
+
+        filtered = (len(parsed.where) > 0 or parsed.permission is not None or
+                    parsed.bbox is not None or parsed.overlaps is not None or
+                    parsed.during is not None)
+        if parsed.all and filtered:
+            parser.error("filters can't be used with --all")
+
+    if parsed.command == "spatial":
+        expected = SPATIAL_COORDS[parsed.query]
+        if len(parsed.coords) != len(expected):
+            parser.error("{} takes {}".format(
+                parsed.query, " ".join(expected) or "no coordinates"))
+
+    if (parsed.command == "taxon" and parsed.query != "rebuild" and
+            len(parsed.taxids) == 0):
+        parser.error("{} requires a taxid".format(parsed.query))
+
+    if (parsed.command == "taxon" and
+            parsed.query in ("descendants", "ancestors", "samples") and
+            len(parsed.taxids) > 1):
+        parser.error("{} takes a single taxid".format(parsed.query))
+
+    if (parsed.command == "index" and parsed.action == "status" and
+            len(parsed.names) > 0):
+        parser.error("status doesn't take index names")
+
+    if (parsed.command == "resolve" and parsed.names_file is None and
+            len(parsed.names) == 0):
+        parser.error("resolve requires names or --file")
+
+    if (parsed.command == "resolve" and
+            not 0 <= parsed.min_score <= 1):
+        parser.error("--min-score must be between 0 and 1")
+    return parsed
 
 
 def cli_init(parser):
@@ -76,6 +148,14 @@ def cli_init(parser):
     return init
 
 
+def cli_migrate(parser):
+    migrate = parser.add_parser(
+        "migrate",
+        help="Add columns missing from a database made by an older version"
+    )
+    return migrate
+
+
 def cli_add(parser):
     add = parser.add_parser("add", help="Add data to the database")
     add.add_argument(
@@ -86,8 +166,60 @@ def cli_add(parser):
     )
     add.add_argument(
         "file",
-        type=argparse.FileType('r'),
-        help="The file you want to add to the database."
+        type=str,
+        help="The file you want to add to the database. Use - for stdin."
+    )
+    add.add_argument(
+        "-f", "--format",
+        type=str,
+        choices=FORMATS,
+        default=None,
+        help=("The format of the file. parquet and arrow require pyarrow. "
+              "Default = guessed from the file suffix, otherwise tsv."),
+    )
+    add.add_argument(
+        "--bulk",
+        action="store_true",
+        default=False,
+        help=("Load the rows with postgres COPY rather than through the ORM. "
+              "Falls back to the ORM for other databases."),
+    )
+    add.add_argument(
+        "-c", "--chunk-size",
+        type=int,
+        default=None,
+        help=("Read, add and commit the file this many rows at a time. "
+              "Default = the whole file at once."),
+    )
+    add.add_argument(
+        "--resume",
+        action="store_true",
+        default=False,
+        help=("Continue a chunked load of this file from the last committed "
+              "chunk. Requires --chunk-size."),
+    )
+    add.add_argument(
+        "--server-buffer",
+        action="store_true",
+        default=False,
+        help=("Pad the gps points of samples without a geom with ST_Buffer "
+              "in the database instead of in python."),
+    )
+    add.add_argument(
+        "-m", "--mode",
+        type=str,
+        choices=MODES,
+        default="insert",
+        help=("insert adds every row. upsert updates rows with the same "
+              "natural key and adds the rest. sync also deletes rows that "
+              "aren't in the file. Default = insert."),
+    )
+    add.add_argument(
+        "--drop-indexes",
+        action="store_true",
+        default=False,
+        help=("Drop the secondary indexes before loading and create them "
+              "again afterwards. Faster for large loads."),
     )
     return add
 
@@ -97,13 +229,278 @@ def cli_dump(parser):
     dump.add_argument(
         "table",
         type=str,
+        nargs="?",
+        default=None,
         choices=TABLES,
-        help=""
+        help="The table to dump. Omit when using --all."
+    )
+    dump.add_argument(
+        "--all",
+        action="store_true",
+        default=False,
+        help=("Dump every table to its own file in --outdir, in parallel "
+              "and from one consistent snapshot."),
     )
     dump.add_argument(
+        "--outdir",
+        type=str,
+        default=None,
+        help="The directory to write to with --all.",
+    )
+    dump.add_argument(
+        "-j", "--jobs",
+        type=int,
+        default=None,
+        help="The number of tables to dump at once with --all. Default = all",
+    )
+    dump_options(dump)
+    return dump
+
+
+def cli_export(parser):
+    export = parser.add_parser(
+        "export",
+        help="Export joined views of the database"
+    )
+    export.add_argument(
+        "view",
+        type=str,
+        choices=VIEWS,
+        help=("The view to export. wide has one row per sample with its "
+              "taxa, contributors and pesticide applications. "
+              "sampletaxon-lineage adds the lineage of each taxon to the "
+              "sample taxa."),
+    )
+    dump_options(export)
+    return export
+
+
+def cli_taxon(parser):
+    taxon = parser.add_parser(
+        "taxon",
+        help="Query the taxon hierarchy"
+    )
+    taxon.add_argument(
+        "query",
+        type=str,
+        choices=["descendants", "ancestors", "lca", "samples", "rebuild"],
+        help=("descendants, ancestors and samples take one taxid, lca takes "
+              "several. rebuild recomputes the hierarchy index."),
+    )
+    taxon.add_argument(
+        "taxids",
+        type=int,
+        nargs="*",
+        help="The NCBI taxids to query.",
+    )
+    taxon.add_argument(
+        "--depth",
+        type=int,
+        default=None,
+        help="Only find descendants this many levels down. Default = all",
+    )
+    return taxon
+
+
+def cli_lineage(parser):
+    lineage = parser.add_parser(
+        "lineage",
+        help="Find the ancestors or descendants of a sample or pesticide"
+    )
+    lineage.add_argument(
+        "key",
+        type=str,
+        help="The sample id or pesticide name to start from.",
+    )
+    lineage.add_argument(
+        "-t", "--table",
+        type=str,
+        choices=["samples", "pesticides"],
+        default="samples",
+        help="The table to search. Default = samples",
+    )
+    direction = lineage.add_mutually_exclusive_group()
+    direction.add_argument(
+        "--up",
+        dest="up",
+        action="store_true",
+        default=True,
+        help="Find the ancestors (default).",
+    )
+    direction.add_argument(
+        "--down",
+        dest="up",
+        action="store_false",
+        help="Find the descendants.",
+    )
+    lineage.add_argument(
+        "--depth",
+        type=int,
+        default=None,
+        help="The number of generations to find. Default = all",
+    )
+    lineage.add_argument(
+        "--edges",
+        action="store_true",
+        default=False,
+        help=("Print the child/parent edges instead of the samples or "
+              "pesticides found."),
+    )
+    return lineage
+
+
+def cli_spatial(parser):
+    spatial = parser.add_parser(
+        "spatial",
+        help="Find samples by location"
+    )
+    spatial.add_argument(
+        "query",
+        type=str,
+        choices=list(SPATIAL_COORDS),
+        help=("contains LON LAT finds samples whose area contains a point. "
+              "within LON LAT KM finds samples within a distance of a point. "
+              "bbox XMIN YMIN XMAX YMAX finds samples intersecting a box. "
+              "nearest LON LAT finds the closest samples to a point. "
+              "index creates the spatial index if it's missing."),
+    )
+    spatial.add_argument(
+        "coords",
+        type=float,
+        nargs="*",
+        help="The coordinates for the query, in degrees.",
+    )
+    spatial.add_argument(
+        "-n",
+        type=int,
+        default=10,
+        help="The number of samples to find with nearest. Default = 10",
+    )
+    dump_options(spatial)
+    return spatial
+
+
+def cli_resolve(parser):
+    resolve = parser.add_parser(
+        "resolve",
+        help="Find taxa or samples by approximate name"
+    )
+    resolve.add_argument(
+        "table",
+        type=str,
+        choices=["taxon", "samples"],
+        help="The table to search.",
+    )
+    resolve.add_argument(
+        "names",
+        type=str,
+        nargs="*",
+        help="The names to resolve.",
+    )
+    resolve.add_argument(
+        "--file",
+        dest="names_file",
+        type=argparse.FileType("r"),
+        default=None,
+        help="Also resolve the names in this file, one per line. '-' = stdin",
+    )
+    resolve.add_argument(
+        "--min-score",
+        type=float,
+        default=0.3,
+        help="The lowest trigram similarity to count as a match. Default 0.3",
+    )
+    resolve.add_argument(
+        "--rebuild",
+        action="store_true",
+        default=False,
+        help="Rebuild the name index first.",
+    )
+    return resolve
+
+
+def cli_index(parser):
+    index = parser.add_parser(
+        "index",
+        help="Manage the secondary indexes"
+    )
+    index.add_argument(
+        "action",
+        type=str,
+        choices=["create", "drop", "status"],
+        help=("create or drop the secondary indexes on foreign key and "
+              "lookup columns, or report the size and usage of indexes."),
+    )
+    index.add_argument(
+        "names",
+        type=str,
+        nargs="*",
+        help="Only create or drop these indexes. Default = all of them.",
+    )
+    return index
+
+
+def dump_options(parser):
+    """ Output and filter options shared by dump and export. """
+    parser.add_argument(
         "-o", "--output",
-        type=argparse.FileType('w'),
-        default=sys.stdout,
+        type=str,
+        default=None,
         help="The file that you want to dump to. Default = stdout",
     )
-    return dump
+    parser.add_argument(
+        "-f", "--format",
+        type=str,
+        choices=FORMATS,
+        default="tsv",
+        help=("The format to write. parquet and arrow keep column types and "
+              "require pyarrow. Default = tsv"),
+    )
+    parser.add_argument(
+        "-w", "--where",
+        type=str,
+        action="append",
+        default=[],
+        help=("Only dump rows matching a filter, e.g. date>=2019-01-01 or "
+              "type=sample,mutant. Can be given multiple times."),
+    )
+    parser.add_argument(
+        "--permission",
+        type=str,
+        default=None,
+        help="Only dump samples with this permission.",
+    )
+    parser.add_argument(
+        "--overlaps",
+        type=str,
+        nargs=2,
+        default=None,
+        metavar=("START", "END"),
+        help=("Only dump rows whose dates could be between START and END "
+              "(YYYY-MM-DD, END excluded), given their date resolution."),
+    )
+    parser.add_argument(
+        "--during",
+        type=str,
+        nargs=2,
+        default=None,
+        metavar=("START", "END"),
+        help=("Only dump rows whose dates are certainly between START and "
+              "END (YYYY-MM-DD, END excluded)."),
+    )
+    parser.add_argument(
+        "--bbox",
+        type=float,
+        nargs=4,
+        default=None,
+        metavar=("XMIN", "YMIN", "XMAX", "YMAX"),
+        help="Only dump samples intersecting this lon/lat bounding box.",
+    )
+    parser.add_argument(
+        "-b", "--batch-size",
+        type=int,
+        default=DUMP_BATCH_SIZE,
+        help=("The number of rows to fetch and write at a time. "
+              "Default = {}".format(DUMP_BATCH_SIZE)),
+    )
+    return
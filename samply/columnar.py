@@ -0,0 +1,227 @@
+"""
+Reading and writing tables in columnar formats (Parquet and Arrow IPC)
+with pyarrow.
+
+Table classes describe the types of their dump columns with `dump_types`,
+mapping column names to one of "list", "date", "int", "float", or an enum
+from samply.vocabularies. Other columns are written as strings.
+Enums are dictionary encoded with all of the members of the enum, so that
+every batch shares the same dictionary.
+"""
+
+import enum
+import logging
+from datetime import date, datetime
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ("tsv", "parquet", "arrow")
+
+SUFFIXES = {
+    ".parquet": "parquet",
+    ".pq": "parquet",
+    ".arrow": "arrow",
+    ".feather": "arrow",
+    ".ipc": "arrow",
+}
+
+
+def _pyarrow():
+    # pyarrow is an optional dependency, only needed for these formats.
+    try:
+        import pyarrow
+        import pyarrow.ipc  # noqa
+        import pyarrow.parquet  # noqa
+    except ImportError:
+        raise ImportError(
+            "Reading or writing parquet or arrow requires pyarrow. "
+            "Install it with `pip install samply[columnar]`."
+        )
+    return pyarrow
+
+
+def arrow_type(spec):
+    pa = _pyarrow()
+
+    if spec == "list":
+        return pa.list_(pa.string())
+    elif spec == "date":
+        return pa.date32()
+    elif spec == "int":
+        return pa.int64()
+    elif spec == "float":
+        return pa.float64()
+    elif isinstance(spec, type) and issubclass(spec, enum.Enum):
+        return pa.dictionary(pa.int32(), pa.string())
+    else:
+        return pa.string()
+
+
+def _missing(value):
+    return value is None or (not isinstance(value, list) and pd.isna(value))
+
+
+def _list(value):
+    if isinstance(value, list):
+        return value
+    elif value == "":
+        return []
+    else:
+        return str(value).split(";")
+
+
+def _date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    elif isinstance(value, date):
+        return value
+    else:
+        return datetime.strptime(str(value)[:10], "%Y-%m-%d").date()
+
+
+def to_array(values, spec):
+    """ Convert a column from a dump DataFrame to an arrow array. """
+    pa = _pyarrow()
+
+    values = [None if _missing(v) else v for v in values]
+
+    if spec == "list":
+        values = [None if v is None else _list(v) for v in values]
+    elif spec == "date":
+        values = [None if v is None else _date(v) for v in values]
+    elif spec == "int":
+        values = [None if v is None else int(v) for v in values]
+    elif spec == "float":
+        values = [None if v is None else float(v) for v in values]
+    elif isinstance(spec, type) and issubclass(spec, enum.Enum):
+        names = [m.name for m in spec]
+        index = {n: i for i, n in enumerate(names)}
+        indices = [
+            None if v is None
+            else index.get(v.name if isinstance(v, enum.Enum) else v)
+            for v in values
+        ]
+        return pa.DictionaryArray.from_arrays(
+            pa.array(indices, type=pa.int32()),
+            pa.array(names, type=pa.string())
+        )
+    else:
+        values = [None if v is None else str(v) for v in values]
+
+    return pa.array(values, type=arrow_type(spec))
+
+
+def to_record_batch(frame, types):
+    pa = _pyarrow()
+    columns = list(frame.columns)
+    arrays = [to_array(frame[c], types.get(c)) for c in columns]
+    return pa.RecordBatch.from_arrays(arrays, names=columns)
+
+
+def write_batches(frames, sink, types, format="parquet"):
+    """ Write an iterable of DataFrames to a parquet or arrow IPC file.
+
+    Each DataFrame is written as its own row group or record batch, so
+    this streams as well as the frames do.
+    """
+
+    pa = _pyarrow()
+    writer = None
+
+    try:
+        for frame in frames:
+            batch = to_record_batch(frame, types)
+
+            if writer is None:
+                if format == "parquet":
+                    writer = pa.parquet.ParquetWriter(sink, batch.schema)
+                elif format == "arrow":
+                    writer = pa.ipc.new_file(sink, batch.schema)
+                else:
+                    raise ValueError("Unknown format {}.".format(format))
+
+            if format == "parquet":
+                writer.write_table(pa.Table.from_batches([batch]))
+            else:
+                writer.write_batch(batch)
+    finally:
+        if writer is not None:
+            writer.close()
+    return
+
+
+def input_format(path):
+    """ Guess the format of an input file from its suffix. """
+    name = str(getattr(path, "name", path)).lower()
+    for suffix, format in SUFFIXES.items():
+        if name.endswith(suffix):
+            return format
+    return "tsv"
+
+
+def _frame(table):
+    # Dates are kept as date objects rather than converted to timestamps.
+    return table.to_pandas(date_as_object=True)
+
+
+def read_table(path, format="parquet"):
+    """ Read a whole parquet or arrow IPC file into a DataFrame. """
+    pa = _pyarrow()
+
+    if format == "parquet":
+        return _frame(pa.parquet.read_table(path))
+    elif format == "arrow":
+        with pa.memory_map(path) as source:
+            return _frame(pa.ipc.open_file(source).read_all())
+    else:
+        raise ValueError("Unknown format {}.".format(format))
+
+
+def _record_batches(path, format, chunksize):
+    pa = _pyarrow()
+
+    if format == "parquet":
+        parquet = pa.parquet.ParquetFile(path)
+        for batch in parquet.iter_batches(batch_size=chunksize):
+            yield batch
+    elif format == "arrow":
+        with pa.memory_map(path) as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                yield reader.get_batch(i)
+    else:
+        raise ValueError("Unknown format {}.".format(format))
+
+
+def read_batches(path, format="parquet", chunksize=10000, skip=0):
+    """ Yield DataFrames of chunksize rows from a parquet or arrow file.
+
+    The first `skip` rows are left out, for resuming loads.
+    """
+
+    pa = _pyarrow()
+    pending = []
+    rows = 0
+
+    for batch in _record_batches(path, format, chunksize):
+        if skip >= batch.num_rows:
+            skip -= batch.num_rows
+            continue
+        elif skip > 0:
+            batch = batch.slice(skip)
+            skip = 0
+
+        pending.append(batch)
+        rows += batch.num_rows
+
+        while rows >= chunksize:
+            table = pa.Table.from_batches(pending)
+            yield _frame(table.slice(0, chunksize))
+            pending = table.slice(chunksize).to_batches()
+            rows -= chunksize
+
+    if rows > 0:
+        yield _frame(pa.Table.from_batches(pending))
+    return
@@ -3,11 +3,13 @@
 
 import json
 import logging
+from collections import defaultdict
 from datetime import datetime
 
 import pandas as pd
 from samply import database as db
 from samply.base import SamplyBase
+from samply.base import INSERT_BATCH_SIZE
 from samply import vocabularies as voc
 from samply import utils
 
@@ -20,6 +22,10 @@ class Contributors(SamplyBase):
     """
 
     table = db.Contributor
+    natural_key = ("name",)
+    dump_types = {
+        "type": voc.ContributorType,
+    }
 
     @staticmethod
     def _to_series(record):
@@ -66,6 +72,62 @@ class Contributors(SamplyBase):
 
         return record
 
+    @staticmethod
+    def _from_frame(table):
+        contact = utils.json_column(table["contact"])
+        phone = table["phone"].astype(str).where(table["phone"].notna())
+        extra = pd.DataFrame({"phone": phone, "email": table["email"]})
+
+        contact = [
+            dict(c, **{k: v for k, v in e.items() if pd.notna(v)})
+            for c, e in zip(contact, utils.frame_to_records(extra))
+        ]
+
+        frame = pd.DataFrame({
+            "type": table["type"],
+            "name": table["name"],
+            "contact": pd.Series(contact, index=table.index, dtype=object),
+        })
+        return utils.frame_to_records(frame)
+
+    def _write_records(self, session, records):
+        """ Names aren't unique, so upserts match existing contributors by
+        name and update them by id. Names matching several contributors
+        can't be updated.
+        """
+
+        if self.mode == "insert":
+            super()._write_records(session, records)
+            return
+
+        ids = defaultdict(set)
+        names = [r["name"] for r in records]
+        for batch in utils.batched(names, INSERT_BATCH_SIZE):
+            query = (
+                session.query(db.Contributor.name, db.Contributor.id)
+                .filter(db.Contributor.name.in_(batch))
+            )
+            for name, id_ in query:
+                ids[name].add(id_)
+
+        ambiguous = sorted(n for n, i in ids.items() if len(i) > 1)
+        if len(ambiguous) > 0:
+            raise ValueError(
+                "Can't update contributors whose names match several "
+                "rows: {}".format(", ".join(ambiguous)))
+
+        updates = [
+            dict(r, id=next(iter(ids[r["name"]])))
+            for r in records
+            if r["name"] in ids
+        ]
+        inserts = [r for r in records if r["name"] not in ids]
+
+        table = self.table.__table__
+        self._write_rows(session, table, updates, key=["id"])
+        self._write_rows(session, table, inserts, key=["id"])
+        return
+
 
 class SampleContribution(SamplyBase):
 
@@ -74,12 +136,23 @@ class SampleContribution(SamplyBase):
     """
 
     table = db.SampleContribution
+    references = {
+        "sample_id": ("sample_id", db.Sample.id),
+        "contributor_name": ("contributor_id", db.Contributor.name,
+                             db.Contributor.id),
+    }
+    natural_key = ("sample_id", "contributor_id", "predicate")
+    eager = ("contributor",)
+    dump_types = {
+        "predicate": voc.SampleContributionPredicate,
+        "datetime": "date",
+    }
 
     @staticmethod
     def _to_series(record):
 
         data = [
-            record.sample.id,
+            record.sample_id,
             record.contributor.name,
             record.predicate.name,
             record.datetime.strftime("%Y-%m-%d"),
@@ -102,22 +175,12 @@ class SampleContribution(SamplyBase):
             datetime=datetime.strptime(series["datetime"], "%Y-%m-%d"),
         )
 
-    def add_records(self, records):
-        """ Recursively add records to database """
-
-        with self.get_session() as session:
-            for record in records:
-                record = utils.tidy_nans(record)
-                sample_id = record.pop("sample_id")
-                contributor_name = record.pop("contributor_name")
-
-                sample = session.query(db.Sample).filter(
-                    db.Sample.id == sample_id).one()
-                contributor = session.query(db.Contributor).filter(
-                    db.Contributor.name == contributor_name).one()
-
-                record["contributor"] = contributor
-                record["sample"] = sample
-                record = self.table(**record)
-                session.add(record)
-        return
+    @staticmethod
+    def _from_frame(table):
+        frame = pd.DataFrame({
+            "sample_id": table["sample_id"],
+            "contributor_name": table["contributor_name"],
+            "predicate": table["predicate"],
+            "datetime": utils.datetime_column(table["datetime"]),
+        })
+        return utils.frame_to_records(frame)
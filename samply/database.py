@@ -6,14 +6,17 @@ from __future__ import unicode_literals
 import logging
 from contextlib import contextmanager
 
+from sqlalchemy import DDL
 from sqlalchemy import Table
+from sqlalchemy import event
+from sqlalchemy import Index
 from sqlalchemy import ForeignKey
 from sqlalchemy import create_engine
 from sqlalchemy import Column
 from sqlalchemy import Integer
 from sqlalchemy import Float
 from sqlalchemy import String
-# from sqlalchemy import Boolean
+from sqlalchemy import Boolean
 from sqlalchemy import Enum
 from sqlalchemy import Date
 from sqlalchemy import DateTime
@@ -24,6 +27,7 @@ from sqlalchemy.orm import relationship
 from sqlalchemy.orm import backref
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.dialects.postgresql import DATERANGE
 
 from geoalchemy2 import Geometry
 
@@ -101,14 +105,16 @@ sampleadjacency = Table(
     Column("parent_id",
            String(SAMPLE_ID_SIZE),
            ForeignKey("sample.id"),
-           primary_key=True)
+           primary_key=True),
+    Index("ix_sampleadjacency_parent_id", "parent_id"),
 )
 
 
 pesticideadjacency = Table(
     "pesticideadjacency", Base.metadata,
     Column("child_id", Integer, ForeignKey("pesticide.id"), primary_key=True),
-    Column("parent_id", Integer, ForeignKey("pesticide.id"), primary_key=True)
+    Column("parent_id", Integer, ForeignKey("pesticide.id"), primary_key=True),
+    Index("ix_pesticideadjacency_parent_id", "parent_id"),
 )
 
 
@@ -117,12 +123,18 @@ class Sample(Base):
     """
     """
 
+    __table_args__ = (
+        Index("ix_sample_date_range", "date_range", postgresql_using="gist"),
+    )
+
     id = Column(String(SAMPLE_ID_SIZE), primary_key=True)
     names = Column(JSONB(none_as_null=True))  # Array
     type = Column(Enum(vocab.SampleType))
 
     date = Column(Date())
     date_resolution = Column(Enum(vocab.DateResolution))
+    # The dates covered by date at its resolution, see utils.date_range.
+    date_range = Column(DATERANGE())
 
     details = Column(JSONB(none_as_null=True))
     permission = Column(Enum(vocab.SamplePermission))
@@ -145,18 +157,29 @@ class Sample(Base):
 
 
 class SampleTaxon(Base):
+    __table_args__ = (
+        Index("ix_sampletaxon_natural_key",
+              "sample_id", "taxon_id", "type",
+              unique=True),
+        Index("ix_sampletaxon_taxon_id", "taxon_id"),
+    )
+
     id = Column(Integer, primary_key=True, autoincrement=True)
     sample_id = Column(String(SAMPLE_ID_SIZE),
                        ForeignKey("sample.id"),
                        primary_key=True)
     taxon_id = Column(Integer, ForeignKey("taxon.taxid"), primary_key=True)
-    type = Column(Enum(vocab.SampleTaxonType))
+    type = Column(Enum(vocab.SampleTaxonType), nullable=False)
     evidence = Column(JSONB(none_as_null=True))
     sample = relationship("Sample", back_populates="taxon")
     taxon = relationship("Taxon", back_populates="samples")
 
 
 class Taxon(Base):
+    __table_args__ = (
+        Index("ix_taxon_parent_taxid", "parent_taxid"),
+    )
+
     taxid = Column(Integer, primary_key=True)
     name = Column(String())
     rank = Column(String())
@@ -167,7 +190,51 @@ class Taxon(Base):
                             backref=backref("parent", remote_side=[taxid]))
 
 
+class TaxonClosure(Base):
+    """ Every ancestor/descendant pair of taxa, including each taxon with
+    itself at depth 0. Rebuilt after taxa are loaded, see samply.taxon.
+    """
+    __table_args__ = (
+        Index("ix_taxonclosure_descendant",
+              "descendant_taxid", "ancestor_taxid"),
+    )
+
+    ancestor_taxid = Column(Integer, primary_key=True)
+    descendant_taxid = Column(Integer, primary_key=True)
+    depth = Column(Integer)
+
+
+# The ranks stored in the taxon lineage table, from the root down.
+LINEAGE_RANKS = ("superkingdom", "kingdom", "phylum", "class", "order",
+                 "family", "genus", "species")
+
+
+"""
+The lineage table denormalises the ancestors of each taxon at the main
+ranks, with a <rank>_taxid and <rank> (name) column for each rank.
+It's derived from the closure table, so it's rebuilt with it.
+"""
+taxonlineage = Table(
+    "taxonlineage", Base.metadata,
+    Column("taxid", Integer, primary_key=True),
+    *[
+        Column(name, type_)
+        for rank in LINEAGE_RANKS
+        for name, type_ in ((rank + "_taxid", Integer), (rank, String()))
+    ]
+)
+
+
 class SamplePesticide(Base):
+    __table_args__ = (
+        Index("ix_samplepesticide_natural_key",
+              "sample_id", "pesticide_id", "date", "application_style",
+              unique=True),
+        Index("ix_samplepesticide_date_range", "date_range",
+              postgresql_using="gist"),
+        Index("ix_samplepesticide_pesticide_id", "pesticide_id"),
+    )
+
     id = Column(Integer, primary_key=True, autoincrement=True)
     sample_id = Column(
         String(SAMPLE_ID_SIZE),
@@ -179,11 +246,13 @@ class SamplePesticide(Base):
         ForeignKey("pesticide.id"),
         primary_key=True
     )
-    date = Column(Date())  # Split into multiple columns?
+    date = Column(Date(), nullable=False)  # Split into multiple columns?
     date_resolution = Column(Enum(vocab.DateResolution))
+    date_range = Column(DATERANGE())
     rate = Column(Float())
     units = Column(String())
-    application_style = Column(Enum(vocab.PesticideApplication))
+    application_style = Column(Enum(vocab.PesticideApplication),
+                               nullable=False)
     stage_applied = Column(String())
     notes = Column(String())
     sample = relationship("Sample", back_populates="pesticides")
@@ -208,6 +277,13 @@ class Pesticide(Base):
 
 
 class SampleContribution(Base):
+    __table_args__ = (
+        Index("ix_samplecontribution_natural_key",
+              "sample_id", "contributor_id", "predicate",
+              unique=True),
+        Index("ix_samplecontribution_contributor_id", "contributor_id"),
+    )
+
     id = Column(Integer, primary_key=True, autoincrement=True)
     sample_id = Column(
         String(SAMPLE_ID_SIZE),
@@ -219,7 +295,8 @@ class SampleContribution(Base):
         ForeignKey("contributor.id"),
         primary_key=True
     )
-    predicate = Column(Enum(vocab.SampleContributionPredicate))
+    predicate = Column(Enum(vocab.SampleContributionPredicate),
+                       nullable=False)
     datetime = Column(DateTime())
     sample = relationship("Sample", back_populates="contributions")
     contributor = relationship("Contributor", back_populates="samples")
@@ -228,7 +305,7 @@ class SampleContribution(Base):
 class Contributor(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     type = Column(Enum(vocab.ContributorType))
-    name = Column(String())
+    name = Column(String(), index=True)
     # Address, email, phone, twitter etc.
     contact = Column(JSONB(none_as_null=True))
     samples = relationship("SampleContribution", back_populates="contributor")
@@ -247,9 +324,66 @@ class LocationHistory(Base):
 
 
 class Phenotype(Base):
+    __table_args__ = (
+        Index("ix_phenotype_sample_id", "sample_id"),
+    )
+
     id = Column(Integer, primary_key=True, autoincrement=True)
     type = Column(Enum(vocab.PhenotypeType))
     date = Column(Date())
     details = Column(JSONB(none_as_null=True))
     sample_id = Column(String(SAMPLE_ID_SIZE), ForeignKey("sample.id"))
     sample = relationship("Sample", back_populates="phenotypes")
+
+
+class LoadCheckpoint(Base):
+    """ Bookkeeping for chunked loads so that they can be resumed.
+
+    All rows before `start` have been committed, and no rows after `rows`
+    have been.
+    """
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    table_name = Column(String())
+    file_digest = Column(String(64))
+    start = Column(Integer, default=0)
+    rows = Column(Integer, default=0)
+    finished = Column(Boolean, default=False)
+    updated = Column(DateTime())
+
+
+class RowHash(Base):
+    """ Content hashes of loaded rows, keyed by table and natural key.
+    Upserts use these to skip rows that haven't changed.
+    """
+    table_name = Column(String(), primary_key=True)
+    row_key = Column(String(), primary_key=True)
+    digest = Column(String(32))
+
+
+class NameIndex(Base):
+    """ The names and aliases of rows, for resolving user typed names.
+
+    Each row of a table has its primary name and aliases (e.g. taxon names
+    and alt_names) here, keyed by the table's key as text. The trigram
+    index on the lower cased name answers fuzzy matches.
+    Rebuilt after loads, see SamplyBase.rebuild_names.
+    """
+    __table_args__ = (
+        Index("ix_nameindex_trgm", "normalised",
+              postgresql_using="gin",
+              postgresql_ops={"normalised": "gin_trgm_ops"}),
+    )
+
+    table_name = Column(String(), primary_key=True)
+    normalised = Column(String(), primary_key=True)
+    key = Column(String(), primary_key=True)
+    name = Column(String())
+
+
+# The trigram index needs pg_trgm.
+event.listen(
+    NameIndex.__table__,
+    "before_create",
+    DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(
+        dialect="postgresql")
+)
@@ -0,0 +1,178 @@
+"""
+Denormalised views of the database, built in a single query.
+"""
+
+import logging
+
+import pandas as pd
+from sqlalchemy import cast
+from sqlalchemy import func
+from sqlalchemy import select
+from sqlalchemy import String
+from sqlalchemy import Text
+from sqlalchemy import true
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+
+from samply import vocabularies as voc
+from samply import database as db
+from samply.samples import Samples
+from samply.samples import DUMP_COLUMNS
+from samply.taxon import SampleTaxon
+
+logger = logging.getLogger(__name__)
+
+PREDICATES = [p.name for p in voc.SampleContributionPredicate]
+
+WIDE_COLUMNS = (
+    DUMP_COLUMNS +
+    ["taxa", "taxids"] +
+    PREDICATES +
+    ["pesticides", "pesticide_applications"]
+)
+
+LIST_COLUMNS = ["names", "parents", "taxa", "taxids", "pesticides"]
+LIST_COLUMNS.extend(PREDICATES)
+
+
+def _array_agg(column, order_by, *criteria):
+    """ An ordered array of the non-null values of column.
+
+    Names are nullable, and NULLs can't be joined in the dump.
+    """
+    return func.array_agg(aggregate_order_by(column, order_by)).filter(
+        column.isnot(None), *criteria)
+
+
+class WideSamples(Samples):
+
+    """
+    One row per sample with its taxa, contributors (a column per predicate)
+    and pesticide applications.
+
+    The many valued relations are aggregated into arrays in lateral
+    subqueries, joined using the relationships declared on db.Sample, so
+    the whole view comes from one streamed query.
+    """
+
+    dump_types = dict(
+        Samples.dump_types,
+        **{c: "list" for c in LIST_COLUMNS}
+    )
+
+    def _dump_query(self, session):
+        taxa = (
+            select(
+                _array_agg(db.Taxon.name, db.Taxon.taxid).label("taxa"),
+                _array_agg(cast(db.Taxon.taxid, String), db.Taxon.taxid)
+                .label("taxids"),
+            )
+            .select_from(db.SampleTaxon)
+            .join(db.SampleTaxon.taxon)
+            .where(db.Sample.taxon.property.primaryjoin)
+            .lateral("taxa")
+        )
+
+        contributions = (
+            select(*[
+                _array_agg(db.Contributor.name, db.Contributor.name,
+                           db.SampleContribution.predicate == p)
+                .label(p.name)
+                for p in voc.SampleContributionPredicate
+            ])
+            .select_from(db.SampleContribution)
+            .join(db.SampleContribution.contributor)
+            .where(db.Sample.contributions.property.primaryjoin)
+            .lateral("contributions")
+        )
+
+        application = func.jsonb_build_object(
+            "pesticide", db.Pesticide.name,
+            "date", func.to_char(db.SamplePesticide.date, "YYYY-MM-DD"),
+            "date_resolution", cast(db.SamplePesticide.date_resolution,
+                                    String),
+            "rate", db.SamplePesticide.rate,
+            "units", db.SamplePesticide.units,
+            "application_style", cast(db.SamplePesticide.application_style,
+                                      String),
+            "stage_applied", db.SamplePesticide.stage_applied,
+            "notes", db.SamplePesticide.notes,
+        )
+
+        pesticides = (
+            select(
+                _array_agg(db.Pesticide.name, db.SamplePesticide.date)
+                .label("pesticides"),
+                func.jsonb_agg(
+                    aggregate_order_by(application, db.SamplePesticide.date)
+                ).label("pesticide_applications"),
+            )
+            .select_from(db.SamplePesticide)
+            .join(db.SamplePesticide.pesticide)
+            .where(db.Sample.pesticides.property.primaryjoin)
+            .lateral("pesticides")
+        )
+
+        query = super()._dump_query(session).select_from(db.Sample)
+        for subquery in (taxa, contributions, pesticides):
+            query = query.outerjoin(subquery, true())
+
+        return query.add_columns(
+            taxa.c.taxa,
+            taxa.c.taxids,
+            *[contributions.c[p] for p in PREDICATES],
+            pesticides.c.pesticides,
+            cast(pesticides.c.pesticide_applications, Text)
+            .label("pesticide_applications"),
+        )
+
+    def _to_frame(self, records):
+        frame = pd.DataFrame.from_records(records, columns=WIDE_COLUMNS)
+        for column in LIST_COLUMNS:
+            if column == "parents":
+                continue
+
+            frame[column] = [
+                "" if v is None else ";".join(v)
+                for v in frame[column]
+            ]
+        return frame
+
+
+class SampleTaxonLineage(SampleTaxon):
+
+    """
+    The sample taxa with the lineage of each taxon at the main ranks, read
+    from the precomputed taxon lineage table rather than by walking up the
+    taxon parents.
+    """
+
+    dump_types = dict(
+        SampleTaxon.dump_types,
+        **{r + "_taxid": "int" for r in db.LINEAGE_RANKS}
+    )
+
+    def _dump_query(self, session):
+        lineage = db.taxonlineage
+        return (
+            session.query(
+                self.table.sample_id,
+                self.table.taxon_id.label("taxid"),
+                cast(self.table.type, String).label("type"),
+                cast(self.table.evidence, Text).label("evidence"),
+                *list(lineage.columns)[1:]
+            )
+            .outerjoin(lineage, lineage.c.taxid == self.table.taxon_id)
+        )
+
+    def _to_frame(self, records):
+        columns = (
+            ["sample_id", "taxid", "type", "evidence"] +
+            [c.name for c in db.taxonlineage.columns][1:]
+        )
+        return pd.DataFrame.from_records(records, columns=columns)
+
+
+VIEWS = {
+    "wide": WideSamples,
+    "sampletaxon-lineage": SampleTaxonLineage,
+}
@@ -0,0 +1,189 @@
+"""
+Filters for dumps, compiled into the WHERE clause of the dump query.
+
+Filters are written as "<column><operator><value>", e.g. "date>=2019-01-01"
+or "permission=noncommercial". The operators are =, !=, <, <=, > and >=.
+With = a comma separated value matches any of the values, e.g.
+"type=sample,mutant". Values are converted to the type of the column, so
+enum columns take member names and date columns take YYYY-MM-DD dates.
+
+The temporal filters compare date range columns with [start, end) windows,
+so that dates with a coarse resolution match any window they could be in.
+
+The spatial filters compare geometry columns with lon/lat coordinates.
+Distances are in metres, computed on the spheroid with geography casts.
+"""
+
+import re
+import enum
+import math
+import logging
+import operator
+from datetime import date, datetime
+
+from sqlalchemy import cast
+from sqlalchemy import Float
+from sqlalchemy import func
+from sqlalchemy.sql import ClauseElement
+from sqlalchemy.dialects.postgresql import Range
+from geoalchemy2 import Geography
+
+logger = logging.getLogger(__name__)
+
+OPERATORS = {
+    "=": operator.eq,
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+# A lower bound on the metres per degree of latitude, so that the boxes
+# around points for distance searches are never too small.
+METRES_PER_DEGREE = 110000
+
+FILTER_REGEX = re.compile(r"^\s*(\w+)\s*(==|!=|<=|>=|=|<|>)\s*(.*?)\s*$")
+
+
+def convert_value(column, value):
+    """ Convert a string to the python type of a column. """
+
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return value
+
+    if issubclass(python_type, enum.Enum):
+        # Will keyerror if invalid
+        return python_type[value]
+    elif python_type is datetime:
+        return datetime.fromisoformat(value)
+    elif python_type is date:
+        return datetime.strptime(value, "%Y-%m-%d").date()
+    elif python_type in (int, float):
+        return python_type(value)
+    else:
+        return value
+
+
+def parse_filter(columns, string):
+    """ Compile a filter string into a SQL expression.
+
+    Keyword arguments:
+    columns -- A dict mapping filterable names to column expressions.
+    string -- The filter, e.g. "date>=2019-01-01".
+    """
+
+    match = FILTER_REGEX.match(string)
+    if match is None:
+        raise ValueError("Couldn't parse the filter {}.".format(string))
+
+    name, op, value = match.groups()
+    if name not in columns:
+        raise ValueError("Can't filter on {}, choose from {}.".format(
+            name, ", ".join(columns)))
+
+    column = columns[name]
+    if op in ("=", "==") and "," in value:
+        values = [convert_value(column, v.strip()) for v in value.split(",")]
+        return column.in_(values)
+
+    return OPERATORS[op](column, convert_value(column, value))
+
+
+def compile_filters(columns, filters):
+    """ Compile a list of filter strings or SQL expressions.
+
+    SQLAlchemy expressions are passed through as they are.
+    """
+
+    if filters is None:
+        return []
+
+    clauses = []
+    for filter_ in filters:
+        if isinstance(filter_, ClauseElement):
+            clauses.append(filter_)
+        else:
+            clauses.append(parse_filter(columns, filter_))
+    return clauses
+
+
+def bbox(column, xmin, ymin, xmax, ymax, srid=4326):
+    """ Geometries intersecting a bounding box, in lon/lat by default. """
+    envelope = func.ST_MakeEnvelope(xmin, ymin, xmax, ymax, srid)
+    return func.ST_Intersects(column, envelope)
+
+
+def point(lon, lat, srid=4326):
+    return func.ST_SetSRID(func.ST_MakePoint(lon, lat), srid)
+
+
+def contains_point(column, lon, lat, srid=4326):
+    """ Geometries containing a lon/lat point. """
+    return func.ST_Intersects(column, point(lon, lat, srid))
+
+
+def within_distance(column, lon, lat, metres, srid=4326):
+    """ Geometries within a distance in metres of a lon/lat point.
+
+    The geography distance is only checked within a box around the point,
+    which can use a spatial index on the geometry column.
+    """
+
+    dlat = metres / METRES_PER_DEGREE
+    scale = max(math.cos(math.radians(lat)), 0.01)
+    dlon = min(dlat / scale, 180)
+
+    centre = point(lon, lat, srid)
+    box = func.ST_Expand(centre, dlon, dlat)
+    return column.op("&&")(box) & func.ST_DWithin(
+        geography(column, srid),
+        geography(centre, srid),
+        metres
+    )
+
+
+def geography(column, srid=4326):
+    return cast(column, Geography(srid=srid))
+
+
+def distance(column, lon, lat, srid=4326):
+    """ The distance in metres between geometries and a lon/lat point. """
+    return func.ST_Distance(
+        geography(column, srid),
+        geography(point(lon, lat, srid), srid)
+    )
+
+
+def knn_distance(column, lon, lat, srid=4326):
+    """ The distance in metres on the sphere between geometries and a
+    lon/lat point, with the <-> operator on geographies.
+
+    Ordering by this can use a GiST index on the column cast to geography.
+    """
+    return geography(column, srid).op("<->", return_type=Float)(
+        geography(point(lon, lat, srid), srid))
+
+
+def _window(start, end):
+    if isinstance(start, str):
+        start = datetime.strptime(start, "%Y-%m-%d").date()
+    if isinstance(end, str):
+        end = datetime.strptime(end, "%Y-%m-%d").date()
+    return Range(start, end, bounds="[)")
+
+
+def overlaps(column, start, end):
+    """ Date ranges that overlap the window from start until end.
+
+    Either end can be None for an open window.
+    """
+    return column.overlaps(_window(start, end))
+
+
+def during(column, start, end):
+    """ Date ranges that are entirely within the window. """
+    return column.contained_by(_window(start, end))
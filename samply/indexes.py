@@ -0,0 +1,147 @@
+"""
+Managing the secondary indexes on foreign key and lookup columns.
+
+These are declared on the models in samply.database, so `samply init`
+creates them. They aren't needed for correctness, so large bulk loads
+can drop them first and create them again afterwards, which is faster
+than updating them row by row. Primary keys and the unique natural key
+indexes are never dropped, upserts rely on them.
+"""
+
+import logging
+
+import pandas as pd
+from sqlalchemy import bindparam
+from sqlalchemy import inspect
+from sqlalchemy import text
+
+from samply import database as db
+
+logger = logging.getLogger(__name__)
+
+SECONDARY_INDEXES = (
+    "ix_sampleadjacency_parent_id",
+    "ix_pesticideadjacency_parent_id",
+    "ix_sampletaxon_taxon_id",
+    "ix_taxon_parent_taxid",
+    "ix_samplepesticide_pesticide_id",
+    "ix_samplecontribution_contributor_id",
+    "ix_contributor_name",
+    "ix_phenotype_sample_id",
+)
+
+STATUS_COLUMNS = [
+    "table", "index", "managed", "exists", "size", "scans", "tuples_read"
+]
+
+STATUS_QUERY = text("""
+SELECT s.relname, s.indexrelname, pg_relation_size(s.indexrelid),
+       s.idx_scan, s.idx_tup_read
+FROM pg_stat_user_indexes AS s
+WHERE s.relname IN :tables
+""").bindparams(bindparam("tables", expanding=True))
+
+
+def get_indexes(names=None):
+    """ Find the Index objects for managed index names.
+
+    Default is all of them.
+    """
+
+    if names is None:
+        names = SECONDARY_INDEXES
+
+    found = {
+        index.name: index
+        for table in db.Base.metadata.tables.values()
+        for index in table.indexes
+        if index.name in SECONDARY_INDEXES
+    }
+
+    missing = [n for n in names if n not in found]
+    if len(missing) > 0:
+        raise ValueError("Unknown indexes {}, choose from {}.".format(
+            ", ".join(missing), ", ".join(SECONDARY_INDEXES)))
+    return [found[n] for n in names]
+
+
+def create_indexes(engine, names=None):
+    """ Create the managed indexes that don't exist yet. """
+
+    inspector = inspect(engine)
+    for index in get_indexes(names):
+        if not inspector.has_table(index.table.name):
+            logger.warning("Skipping %s, the table %s doesn't exist.",
+                           index.name, index.table.name)
+            continue
+        logger.info("Creating index %s.", index.name)
+        index.create(engine, checkfirst=True)
+
+    if engine.dialect.name == "postgresql":
+        # Refresh the planner statistics for the new indexes.
+        tables = {
+            i.table.name for i in get_indexes(names)
+            if inspector.has_table(i.table.name)
+        }
+        with engine.begin() as connection:
+            for table in sorted(tables):
+                connection.execute(text("ANALYZE {}".format(table)))
+    return
+
+
+def drop_indexes(engine, names=None):
+    """ Drop the managed indexes that exist. """
+
+    inspector = inspect(engine)
+    for index in get_indexes(names):
+        if not inspector.has_table(index.table.name):
+            continue
+        logger.info("Dropping index %s.", index.name)
+        index.drop(engine, checkfirst=True)
+    return
+
+
+def index_status(engine):
+    """ Report which indexes exist, and their size and usage on postgres.
+
+    On postgres every index on the samply tables is included, with the
+    size in bytes and the number of scans since statistics were last reset.
+    Otherwise only whether the managed indexes exist is known.
+
+    Returns:
+    A DataFrame with the columns in STATUS_COLUMNS.
+    """
+
+    inspector = inspect(engine)
+    tables = [
+        t for t in db.Base.metadata.tables
+        if inspector.has_table(t)
+    ]
+
+    existing = {
+        index["name"]
+        for table in tables
+        for index in inspector.get_indexes(table)
+    }
+
+    rows = []
+    if engine.dialect.name == "postgresql" and len(tables) > 0:
+        with engine.connect() as connection:
+            stats = connection.execute(STATUS_QUERY, {"tables": tables})
+            for table, name, size, scans, tuples_read in stats:
+                rows.append([
+                    table, name, name in SECONDARY_INDEXES, True,
+                    size, scans, tuples_read
+                ])
+
+    seen = {r[1] for r in rows}
+    for index in get_indexes():
+        if index.name in seen:
+            continue
+        rows.append([
+            index.table.name, index.name, True, index.name in existing,
+            None, None, None
+        ])
+
+    frame = pd.DataFrame.from_records(rows, columns=STATUS_COLUMNS)
+    return frame.sort_values(["table", "index"]).reset_index(drop=True)
@@ -2,14 +2,15 @@
 """
 
 import logging
-from collections import defaultdict
 from datetime import datetime
 import pandas as pd
+from sqlalchemy.dialects.postgresql import Range
 
 from samply import utils
 from samply import vocabularies as voc
 from samply import database as db
 from samply.base import SamplyBase
+from samply.base import key_value
 
 logger = logging.getLogger(__name__)
 
@@ -37,15 +38,25 @@ class Pesticide(SamplyBase):
     """
 
     table = db.Pesticide
+    key = "name"
+    natural_key = ("name",)
+    eager = ("parents",)
+    adjacency = db.pesticideadjacency
+    dump_types = {
+        "pesticide_type": "list",
+        "type": voc.PesticideProductType,
+        "group": "list",
+        "parents": "list",
+    }
 
     @staticmethod
     def _to_series(record):
 
         data = [
             record.name,
-            ";".join(n.name for n in record.pesticide_type),
-            record.type,
-            ";".join(record.group),
+            ";".join(record.pesticide_type or []),
+            key_value(record.type),
+            ";".join(record.group or []),
             record.notes,
             ";".join(p.name for p in record.parents),
             ]
@@ -76,35 +87,82 @@ class Pesticide(SamplyBase):
             parents=array(series["parents"]),
         )
 
-    def add_records(self, records):
-        """ Recursively add records to database """
+    @staticmethod
+    def _from_frame(table):
+        pesticide_type = utils.array_column(table["pesticide_type"])
+        members = {m.name for m in voc.PesticideType}
+        for types in pesticide_type:
+            for t in types:
+                # Will keyerror if invalid
+                if t not in members:
+                    raise KeyError(t)
+
+        frame = pd.DataFrame({
+            "name": table["name"].str.strip(),
+            "pesticide_type": pesticide_type,
+            "type": utils.enum_column(table["type"],
+                                      voc.PesticideProductType),
+            "group": utils.array_column(table["group"]),
+            "notes": table["notes"],
+            "parents": utils.array_column(table["parents"]),
+        })
+        return utils.frame_to_records(frame)
+
+    @staticmethod
+    def _parents(record):
+        return record["parents"]
 
-        roots = []
-        nodes = defaultdict(list)
-        seen = set()
+    def _write_records(self, session, records):
+        """ Add the pesticides, then the edges between them by id. """
+
+        edges = []
         for record in records:
-            parents = record.pop("parents")
-            record = utils.tidy_nans(record)
-            node = self.table(**record)
-            seen.add(node.name)
-            if len(parents) == 0:
-                roots.append(node)
-            else:
-                for parent in parents:
-                    nodes[parent].append(node)
-
-        for n in nodes.keys():
-            assert (n in seen), f"{n} not in nodes"
-
-        def recurse(node, memo):
-            for child in memo[node.name]:
-                node.children.append(recurse(child, memo))
-            return node
-
-        trees = [recurse(p, nodes) for p in roots]
-
-        with self.get_session() as session:
-            session.add_all(trees)
+            for parent in dict.fromkeys(record.pop("parents")):
+                edges.append((record["name"], parent))
+
+        self._write_rows(
+            session,
+            self.table.__table__,
+            records,
+            key=self._natural_key()
+        )
+
+        names = {n for edge in edges for n in edge}
+        names.update(r["name"] for r in records)
+        ids = dict(
+            session.query(db.Pesticide.name, db.Pesticide.id)
+            .filter(db.Pesticide.name.in_(names))
+        )
+
+        if self.mode != "insert":
+            # The parents of updated pesticides are replaced.
+            adjacency = db.pesticideadjacency
+            session.execute(adjacency.delete().where(
+                adjacency.c.child_id.in_([ids[r["name"]] for r in records])
+            ))
+
+        self._write_rows(
+            session,
+            db.pesticideadjacency,
+            [{"child_id": ids[c], "parent_id": ids[p]} for c, p in edges]
+        )
+        return
+
+    def _delete_keys(self, session, keys):
+        """ Delete the edges of the pesticides first. """
+
+        names = [k for k, in keys]
+        ids = [
+            i for i, in
+            session.query(db.Pesticide.id)
+            .filter(db.Pesticide.name.in_(names))
+        ]
+
+        adjacency = db.pesticideadjacency
+        session.execute(adjacency.delete().where(
+            adjacency.c.child_id.in_(ids) | adjacency.c.parent_id.in_(ids)
+        ))
+        super()._delete_keys(session, keys)
         return
 
 
@@ -115,12 +173,26 @@ class SamplePesticide(SamplyBase):
     """
 
     table = db.SamplePesticide
+    references = {
+        "sample_id": ("sample_id", db.Sample.id),
+        "pesticide_name": ("pesticide_id", db.Pesticide.name,
+                           db.Pesticide.id),
+    }
+    natural_key = ("sample_id", "pesticide_id", "date", "application_style")
+    temporal = "date_range"
+    eager = ("pesticide",)
+    dump_types = {
+        "date": "date",
+        "date_resolution": voc.DateResolution,
+        "rate": "float",
+        "application_style": voc.PesticideApplication,
+    }
 
     @staticmethod
     def _to_series(record):
 
         data = [
-            record.sample.id,
+            record.sample_id,
             record.pesticide.name,
             record.date.strftime("%Y-%m-%d"),
             record.date_resolution.name,
@@ -151,11 +223,18 @@ class SamplePesticide(SamplyBase):
         else:
             rate = float(series["rate"])
 
+        date = datetime.strptime(series["date"], "%Y-%m-%d").date()
+        date_resolution = voc.DateResolution[series["date_resolution"]]
+
         return dict(
             sample_id=series["sample_id"].strip(),
             pesticide_name=series["pesticide_name"].strip().lower(),
-            date=datetime.strptime(series["date"], "%Y-%m-%d").date(),
-            date_resolution=voc.DateResolution[series["date_resolution"]],
+            date=date,
+            date_resolution=date_resolution,
+            date_range=Range(
+                *utils.date_range(date, date_resolution),
+                bounds="[)"
+            ),
             rate=rate,
             units=series["units"],
             application_style=voc.PesticideApplication[
@@ -164,23 +243,21 @@ class SamplePesticide(SamplyBase):
             notes=series["notes"],
         )
 
-    def add_records(self, records):
-        """ Recursively add records to database """
-
-        with self.get_session() as session:
-            for record in records:
-                record = utils.tidy_nans(record)
-                pesticide_name = record.pop("pesticide_name")
-                sample_id = record.pop("sample_id")
-
-                print(pesticide_name, sample_id)
-                sample = session.query(db.Sample).filter(
-                    db.Sample.id == sample_id).one()
-                pesticide = session.query(db.Pesticide).filter(
-                    db.Pesticide.name == pesticide_name).one()
-
-                record["pesticide"] = pesticide
-                record["sample"] = sample
-                record = self.table(**record)
-                session.add(record)
-        return
+    @staticmethod
+    def _from_frame(table):
+        frame = pd.DataFrame({
+            "sample_id": table["sample_id"].str.strip(),
+            "pesticide_name": table["pesticide_name"].str.strip().str.lower(),
+            "date": utils.date_column(table["date"]),
+            "date_resolution": utils.enum_column(table["date_resolution"],
+                                                 voc.DateResolution),
+            "rate": table["rate"].astype(float),
+            "units": table["units"],
+            "application_style": utils.enum_column(
+                table["application_style"], voc.PesticideApplication),
+            "stage_applied": table["stage_applied"],
+            "notes": table["notes"],
+        })
+        frame["date_range"] = utils.date_range_column(
+            frame["date"], frame["date_resolution"])
+        return utils.frame_to_records(frame)
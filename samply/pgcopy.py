@@ -0,0 +1,199 @@
+"""
+Bulk loading of records into PostgreSQL using COPY.
+
+Rows are formatted in COPY's text format as psycopg2 reads them, so the
+whole table never needs to be held as one string.
+"""
+
+import enum
+import json
+import logging
+from datetime import date, datetime
+
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.dialects.postgresql import Range
+from geoalchemy2 import Geometry
+
+logger = logging.getLogger(__name__)
+
+NULL = "\\N"
+
+ESCAPES = str.maketrans({
+    "\\": "\\\\",
+    "\t": "\\t",
+    "\n": "\\n",
+    "\r": "\\r",
+})
+
+
+def available(engine):
+    """ COPY is only available through psycopg2 on postgres. """
+    return (engine.dialect.name == "postgresql" and
+            engine.dialect.driver == "psycopg2")
+
+
+def format_value(column, value):
+    """ Format a single value in COPY's text format. """
+
+    if value is None:
+        return NULL
+    elif isinstance(column.type, JSONB):
+        value = json.dumps(value)
+    elif isinstance(value, enum.Enum):
+        value = value.name
+    elif isinstance(value, Range):
+        value = format_range(value)
+    elif isinstance(value, (date, datetime)):
+        value = value.isoformat()
+    elif isinstance(value, float) and value != value:
+        return NULL
+    elif isinstance(column.type, Geometry) and isinstance(value, bytes):
+        # EWKB, postgis reads the hex form.
+        value = value.hex()
+    else:
+        value = str(value)
+
+    return value.translate(ESCAPES)
+
+
+def format_range(value):
+    """ Format a range in postgres' range literal syntax. """
+    if value.empty:
+        return "empty"
+
+    lower = "" if value.lower is None else value.lower.isoformat()
+    upper = "" if value.upper is None else value.upper.isoformat()
+    return "{}{},{}{}".format(
+        "(" if value.lower is None else value.bounds[0],
+        lower,
+        upper,
+        ")" if value.upper is None else value.bounds[1],
+    )
+
+
+class CopyReader(object):
+
+    """
+    A minimal file-like object that formats rows lazily for copy_expert.
+    """
+
+    def __init__(self, columns, rows):
+        self.columns = columns
+        self.lines = (self.format_row(r) for r in rows)
+        self.buffer = ""
+        return
+
+    def format_row(self, row):
+        values = [format_value(c, row.get(c.name)) for c in self.columns]
+        return "\t".join(values) + "\n"
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += next(self.lines)
+            except StopIteration:
+                break
+
+        if size < 0:
+            size = len(self.buffer)
+
+        output = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return output
+
+    def readline(self, size=-1):
+        if self.buffer == "":
+            self.buffer = next(self.lines, "")
+
+        end = self.buffer.find("\n") + 1 or len(self.buffer)
+        output = self.buffer[:end]
+        self.buffer = self.buffer[end:]
+        return output
+
+
+def copy_rows(connection, table, rows, columns=None):
+    """ Copy a list of dicts into a table.
+
+    Keyword arguments:
+    connection -- A SQLAlchemy connection using psycopg2.
+    table -- The SQLAlchemy Table to copy into.
+    rows -- A list of dicts keyed by column name.
+    columns -- The columns to copy. Defaults to the table columns present
+        in the first row, so autoincrementing ids can be left out.
+    """
+
+    if len(rows) == 0:
+        return
+
+    if columns is None:
+        columns = [c.name for c in table.columns if c.name in rows[0]]
+
+    columns = [table.c[c] for c in columns]
+
+    preparer = connection.dialect.identifier_preparer
+    statement = "COPY {} ({}) FROM STDIN".format(
+        preparer.format_table(table),
+        ", ".join(preparer.quote(c.name) for c in columns)
+    )
+
+    logger.debug("Copying %s rows into %s.", len(rows), table.name)
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(statement, CopyReader(columns, rows))
+    finally:
+        cursor.close()
+    return
+
+
+def copy_upsert(connection, table, rows, key, columns=None):
+    """ Copy a list of dicts into a table, updating rows that conflict.
+
+    The rows are copied into a temporary staging table, then inserted
+    with ON CONFLICT on the key columns, which must have a unique index.
+    Rows with only key columns are left alone if they exist.
+    """
+
+    if len(rows) == 0:
+        return
+
+    if columns is None:
+        columns = [c.name for c in table.columns if c.name in rows[0]]
+
+    preparer = connection.dialect.identifier_preparer
+    target = preparer.format_table(table)
+    stage = preparer.quote("stage_" + table.name)
+    names = ", ".join(preparer.quote(c) for c in columns)
+    conflict = ", ".join(preparer.quote(c) for c in key)
+    updates = ", ".join(
+        "{0} = EXCLUDED.{0}".format(preparer.quote(c))
+        for c in columns
+        if c not in key
+    )
+
+    if updates == "":
+        action = "DO NOTHING"
+    else:
+        action = "DO UPDATE SET " + updates
+
+    cursor = connection.connection.cursor()
+    try:
+        cursor.execute(
+            "CREATE TEMPORARY TABLE {} (LIKE {} INCLUDING DEFAULTS) "
+            "ON COMMIT DROP".format(stage, target)
+        )
+
+        logger.debug("Copying %s rows into %s.", len(rows), stage)
+        cursor.copy_expert(
+            "COPY {} ({}) FROM STDIN".format(stage, names),
+            CopyReader([table.c[c] for c in columns], rows)
+        )
+
+        cursor.execute(
+            "INSERT INTO {0} ({1}) SELECT {1} FROM {2} "
+            "ON CONFLICT ({3}) {4}".format(
+                target, names, stage, conflict, action)
+        )
+        cursor.execute("DROP TABLE {}".format(stage))
+    finally:
+        cursor.close()
+    return
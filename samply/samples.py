@@ -3,27 +3,67 @@
 
 import json
 import logging
-from collections import defaultdict
 from datetime import datetime
 
+import numpy as np
 import pandas as pd
-from geoalchemy2 import shape
+from sqlalchemy import cast
+from sqlalchemy import Float
+from sqlalchemy import func
+from sqlalchemy import String
+from sqlalchemy import Text
+from sqlalchemy import select
+from sqlalchemy import union_all
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.dialects.postgresql import Range
+from sqlalchemy.dialects.postgresql import array
 
 from samply import vocabularies as voc
 from samply import database as db
 from samply.base import SamplyBase
+from samply.base import INSERT_BATCH_SIZE
+from samply import filters
 from samply import utils
 
 logger = logging.getLogger(__name__)
 
+# Fields of location_support that are dumped as their own columns.
+ADDRESS_FIELDS = ("street_address", "suburb", "state", "country")
+
+DUMP_COLUMNS = [
+    "id", "names", "type", "date", "date_resolution", "details",
+    "permission", "parents", "geom", "location_type", "latitude",
+    "longitude", "street_address", "suburb", "state", "country",
+    "location_support",
+]
+
+
+# The padding around gps points without a geometry, in degrees.
+BUFFER_DISTANCE = 0.5
+
+
+def points_to_polys(n, e, d=BUFFER_DISTANCE):
+    """ Converts arrays of gps points to padded polygons.
+
+    All of the points are buffered in one vectorised call, and returned
+    as hex EWKB strings, which postgis reads for both COPY and inserts.
+    """
+    import shapely
+    points = shapely.points(
+        np.asarray(e, dtype=float),
+        np.asarray(n, dtype=float)
+    )
+    # The same resolution as shapely's Point.buffer.
+    polys = shapely.buffer(points, d, quad_segs=16)
+    polys = shapely.set_srid(polys, 4326)
+    return list(shapely.to_wkb(polys, hex=True, include_srid=True))
+
 
 @utils.log(logger, logging.DEBUG)
-def point_to_poly(n, e, d=0.5):
+def point_to_poly(n, e, d=BUFFER_DISTANCE):
     """ Converts a gps point to a padded polygon """
-    from shapely.geometry import Point
-    x = Point(e, n)
-    y = x.buffer(distance=d)
-    return "SRID=4326;" + y.wkt
+    return points_to_polys([n], [e], d)[0]
 
 
 def json_serialise(val):
@@ -47,54 +87,83 @@ def array_serialise(val):
 class Samples(SamplyBase):
 
     table = db.Sample
+    key = "id"
+    geometry = "geom"
+    temporal = "date_range"
+    adjacency = db.sampleadjacency
+    dump_types = {
+        "names": "list",
+        "type": voc.SampleType,
+        "date": "date",
+        "date_resolution": voc.DateResolution,
+        "permission": voc.SamplePermission,
+        "parents": "list",
+        "location_type": voc.LocationType,
+        "latitude": "float",
+        "longitude": "float",
+    }
 
-    @staticmethod
-    def _to_series(record):
-        data = [
-            record.id,
-            ";".join(record.names),
-            record.type.name,
-            record.date.strftime("%Y-%m-%d"),
-            record.date_resolution.name,
-            json.dumps(record.details),
-            record.permission.name,
-            ";".join(p.id for p in record.parents),
-            shape.to_shape(record.geom),
-            record.location_type.name,
-            record.location_support.get("latitude"),
-            record.location_support.get("longitude"),
-            record.location_support.get("street_address"),
-            record.location_support.get("suburb"),
-            record.location_support.get("state"),
-            record.location_support.get("country"),
-            json.dumps({
-                k: v
-                for k, v
-                in record.location_support.items()
-                if k not in ("street_address", "suburb", "state", "country")
-            }),
-        ]
+    def __init__(self, engine, server_buffer=False, **kwargs):
+        """ With server_buffer, samples without a geometry are padded with
+        ST_Buffer in the database rather than with shapely.
+        """
+        super().__init__(engine, **kwargs)
+        self.server_buffer = server_buffer
+        return
 
-        names = [
-            "id",
-            "names",
-            "type",
-            "date",
-            "date_resolution",
-            "details",
-            "permission",
-            "parents",
-            "geom",
-            "location_type",
-            "latitude",
-            "longitude",
-            "street_address",
-            "suburb",
-            "state",
-            "country",
-            "location_support",
-        ]
-        return pd.Series(data, index=names)
+    def _dump_query(self, session):
+        """ Flatten the samples in SQL.
+
+        The geometry comes back as EWKT and the location support fields as
+        text, so dumping needs no ORM objects or shapely geometries.
+        """
+
+        adjacency = db.sampleadjacency
+        parents = (
+            session.query(func.string_agg(adjacency.c.parent_id, ";"))
+            .filter(adjacency.c.child_id == db.Sample.id)
+            .correlate(db.Sample)
+            .scalar_subquery()
+        )
+
+        location = db.Sample.location_support
+        remainder = location.op("-", return_type=JSONB)(
+            cast(array(ADDRESS_FIELDS), ARRAY(Text)))
+
+        return session.query(
+            db.Sample.id.label("id"),
+            db.Sample.names.label("names"),
+            cast(db.Sample.type, String).label("type"),
+            func.to_char(db.Sample.date, "YYYY-MM-DD").label("date"),
+            cast(db.Sample.date_resolution, String).label("date_resolution"),
+            cast(db.Sample.details, Text).label("details"),
+            cast(db.Sample.permission, String).label("permission"),
+            func.coalesce(parents, "").label("parents"),
+            func.ST_AsEWKT(db.Sample.geom).label("geom"),
+            cast(db.Sample.location_type, String).label("location_type"),
+            location["latitude"].astext.label("latitude"),
+            location["longitude"].astext.label("longitude"),
+            location["street_address"].astext.label("street_address"),
+            location["suburb"].astext.label("suburb"),
+            location["state"].astext.label("state"),
+            location["country"].astext.label("country"),
+            cast(remainder, Text).label("location_support"),
+        )
+
+    def _filter_columns(self):
+        """ The location support fields can be filtered on as well. """
+        columns = super()._filter_columns()
+        location = db.Sample.location_support
+        for field in ADDRESS_FIELDS:
+            columns[field] = location[field].astext
+        for field in ("latitude", "longitude"):
+            columns[field] = cast(location[field].astext, Float)
+        return columns
+
+    def _to_frame(self, records):
+        frame = pd.DataFrame.from_records(records, columns=DUMP_COLUMNS)
+        frame["names"] = [";".join(n) for n in frame["names"]]
+        return frame
 
     @staticmethod
     def _from_series(series):
@@ -105,6 +174,10 @@ class Samples(SamplyBase):
         record["date"] = datetime.strptime(series["date"], "%Y-%m-%d").date()
         record["date_resolution"] = voc.DateResolution[
             series["date_resolution"]]
+        record["date_range"] = Range(
+            *utils.date_range(record["date"], record["date_resolution"]),
+            bounds="[)"
+        )
         record["details"] = json_serialise(series["details"])
         record["permission"] = voc.SamplePermission[series["permission"]]
         record["parents"] = array_serialise(series["parents"])
@@ -124,10 +197,8 @@ class Samples(SamplyBase):
         if pd.notna(series["geom"]):
             record["geom"] = series["geom"]
         else:
-            record["geom"] = point_to_poly(
-                location_support["latitude"],
-                location_support["longitude"]
-            )
+            # Padded from the gps point when written.
+            record["geom"] = None
 
         record["location_type"] = voc.LocationType[series["location_type"]]
         if record["id"] in record["parents"]:
@@ -135,30 +206,129 @@ class Samples(SamplyBase):
                 record["id"]))
         return record
 
-    def add_records(self, records):
-        """ Recursively add records to database """
+    @staticmethod
+    def _from_frame(table):
+        frame = pd.DataFrame({
+            "id": table["id"],
+            "type": table["type"],
+            "names": utils.array_column(table["names"]),
+            "date": utils.date_column(table["date"]),
+            "date_resolution": utils.enum_column(table["date_resolution"],
+                                                 voc.DateResolution),
+            "details": utils.json_column(table["details"]),
+            "permission": utils.enum_column(table["permission"],
+                                            voc.SamplePermission),
+            "parents": utils.array_column(table["parents"]),
+        })
+        frame["date_range"] = utils.date_range_column(
+            frame["date"], frame["date_resolution"])
+
+        fields = table[["latitude", "longitude", "street_address",
+                        "suburb", "state", "country"]].astype(object)
+        for field in ("latitude", "longitude"):
+            fields[field] = table[field].astype(float)
+
+        location_support = [
+            dict(ls, **{k: v for k, v in f.items() if pd.notna(v)})
+            for ls, f
+            in zip(utils.json_column(table["location_support"]),
+                   utils.frame_to_records(fields))
+        ]
+        frame["location_support"] = pd.Series(
+            location_support, index=table.index, dtype=object)
 
-        logger.info("Processing taxon file.")
+        # Missing geometries are padded from the gps point when written.
+        missing = table["geom"].isna()
+        for id_, ls in zip(frame.loc[missing, "id"],
+                           frame.loc[missing, "location_support"]):
+            if "latitude" not in ls or "longitude" not in ls:
+                raise ValueError(
+                    "{} has no geom, latitude or longitude.".format(id_))
 
-        roots = []
-        nodes = defaultdict(list)
+        frame["geom"] = table["geom"].astype(object)
+
+        frame["location_type"] = utils.enum_column(table["location_type"],
+                                                   voc.LocationType)
+
+        for id_, parents in zip(frame["id"], frame["parents"]):
+            if id_ in parents:
+                raise ValueError("{} is present as child and parent".format(
+                    id_))
+
+        return utils.frame_to_records(frame)
+
+    @staticmethod
+    def _parents(record):
+        return record["parents"]
+
+    def _write_records(self, session, records):
+        """ Add the samples, then the edges between them. """
+
+        edges = []
         for record in records:
-            parents = record.pop("parents")
-            record = utils.tidy_nans(record)
-            node = self.table(**record)
-            if pd.isna(parents) or len(parents) == 0:
-                roots.append(node)
-            else:
-                for parent in parents:
-                    nodes[parent].append(node)
-
-        def recurse(node, memo):
-            for child in memo[node.id]:
-                node.children.append(recurse(child, memo))
-            return node
-
-        tree = [recurse(root, nodes) for root in roots]
-
-        with self.get_session() as session:
-            session.add_all(tree)
+            for parent in dict.fromkeys(record.pop("parents")):
+                edges.append({"child_id": record["id"], "parent_id": parent})
+
+        missing = [r for r in records if r.get("geom") is None]
+        if len(missing) > 0 and not self.server_buffer:
+            polys = points_to_polys(
+                [r["location_support"]["latitude"] for r in missing],
+                [r["location_support"]["longitude"] for r in missing],
+            )
+            for record, poly in zip(missing, polys):
+                record["geom"] = poly
+
+        self._write_rows(session, self.table.__table__, records)
+
+        if len(missing) > 0 and self.server_buffer:
+            self._buffer_points(session, [r["id"] for r in missing])
+
+        if self.mode != "insert":
+            # The parents of updated samples are replaced.
+            adjacency = db.sampleadjacency
+            session.execute(adjacency.delete().where(
+                adjacency.c.child_id.in_([r["id"] for r in records])
+            ))
+
+        self._write_rows(session, db.sampleadjacency, edges)
+        return
+
+    def _name_query(self):
+        """ Samples are found by id or any of their names. """
+        sample = db.Sample.__table__
+        names = func.jsonb_array_elements_text(sample.c.names)
+        return union_all(
+            select(sample.c.id.label("key"), sample.c.id.label("name")),
+            select(sample.c.id, names.column_valued())
+            .where(sample.c.names.isnot(None)),
+        )
+
+    @staticmethod
+    def _buffer_points(session, ids, d=BUFFER_DISTANCE):
+        """ Set the geometries of samples to their padded gps points. """
+
+        location = db.Sample.location_support
+        point = filters.point(
+            cast(location["longitude"].astext, Float),
+            cast(location["latitude"].astext, Float),
+        )
+
+        table = db.Sample.__table__
+        for i in range(0, len(ids), INSERT_BATCH_SIZE):
+            session.execute(
+                table.update()
+                .where(table.c.id.in_(ids[i:i + INSERT_BATCH_SIZE]))
+                .values(geom=func.ST_Buffer(point, d, "quad_segs=16"))
+            )
+        return
+
+    def _delete_keys(self, session, keys):
+        """ Delete the edges of the samples first. """
+
+        ids = [k for k, in keys]
+        adjacency = db.sampleadjacency
+        session.execute(adjacency.delete().where(
+            adjacency.c.child_id.in_(ids) | adjacency.c.parent_id.in_(ids)
+        ))
+        super()._delete_keys(session, keys)
         return
@@ -3,12 +3,21 @@
 
 import logging
 import json
-from collections import defaultdict
 import pandas as pd
+from sqlalchemy import case
+from sqlalchemy import cast
+from sqlalchemy import func
+from sqlalchemy import literal
+from sqlalchemy import select
+from sqlalchemy import String
+from sqlalchemy import union_all
 
 from samply import utils
 from samply import database as db
+from samply import vocabularies as voc
 from samply.base import SamplyBase
+from samply.base import INSERT_BATCH_SIZE
+from samply.base import key_value
 
 logger = logging.getLogger(__name__)
 
@@ -20,6 +29,12 @@ class Taxon(SamplyBase):
     """
 
     table = db.Taxon
+    key = "taxid"
+    dump_types = {
+        "alt_names": "list",
+        "taxid": "int",
+        "parent_taxid": "int",
+    }
 
     @staticmethod
     def _to_series(record):
@@ -56,35 +71,253 @@ class Taxon(SamplyBase):
             rank=series["rank"],
         )
 
-    def add_records(self, records):
-        """ Recursively add records to database """
+    @staticmethod
+    def _from_frame(table):
+        frame = pd.DataFrame({
+            "name": table["name"],
+            "alt_names": utils.array_column(table["alt_names"]),
+            # A missing parent makes the column float, keep it integer
+            # so the ids don't reach COPY as "9606.0".
+            "taxid": table["taxid"].astype("Int64"),
+            "parent_taxid": table["parent_taxid"].astype("Int64"),
+            "rank": table["rank"],
+        })
+        return utils.frame_to_records(frame)
 
-        logger.info("Processing taxon file.")
+    @staticmethod
+    def _parents(record):
+        parent = record["parent_taxid"]
+        if parent is None or parent == record["taxid"]:
+            return []
+        else:
+            return [parent]
 
-        root = None
-        nodes = defaultdict(list)
-        for record in records:
-            record = utils.tidy_nans(record)
-            node = self.table(**record)
-            if node.taxid == 1:
-                root = node
-            else:
-                nodes[node.parent_taxid].append(node)
+    def _after_load(self):
+        self.rebuild_hierarchy()
+        super()._after_load()
+        return
 
-        logger.info("Constructing tree.")
+    def _name_query(self):
+        """ Taxa are found by name, any of their alt_names or taxid. """
+        taxon = db.Taxon.__table__
+        key = cast(taxon.c.taxid, String)
+        alt_names = func.jsonb_array_elements_text(taxon.c.alt_names)
+        return union_all(
+            select(key.label("key"), taxon.c.name.label("name")),
+            select(key, key),
+            select(key, alt_names.column_valued())
+            .where(taxon.c.alt_names.isnot(None)),
+        )
 
-        def recurse(node, memo):
-            for child in memo[node.taxid]:
-                node.children.append(recurse(child, memo))
-            return node
+    def _delete_keys(self, session, keys):
+        """ Delete the closure rows of the taxa first.
+
+        The taxa are deleted children first, so that no statement deletes
+        a parent whose children are left for a later one.
+        """
+
+        rows = []
+        for batch in utils.batched(keys, INSERT_BATCH_SIZE):
+            query = (
+                session.query(db.Taxon.taxid, db.Taxon.parent_taxid)
+                .filter(db.Taxon.taxid.in_([k for k, in batch]))
+            )
+            rows.extend(
+                {"taxid": t, "parent_taxid": p}
+                for t, p in query
+            )
+
+        order = reversed(self._topological_order(rows))
+        keys = [(r["taxid"],) for r in order]
+
+        taxids = [k for k, in keys]
+        closure = db.TaxonClosure
+        session.query(closure).filter(
+            closure.ancestor_taxid.in_(taxids) |
+            closure.descendant_taxid.in_(taxids)
+        ).delete(synchronize_session=False)
+
+        lineage = db.taxonlineage
+        session.execute(lineage.delete().where(lineage.c.taxid.in_(taxids)))
+        super()._delete_keys(session, keys)
+        return
 
-        tree = recurse(root, nodes)
+    def rebuild_hierarchy(self):
+        """ Rebuild the taxon closure table with one recursive query.
+
+        The root of the NCBI taxonomy is its own parent, so self references
+        are treated as having no parent.
+        """
+
+        closure = db.TaxonClosure.__table__
+        closure.create(self.engine, checkfirst=True)
+        taxon = db.Taxon.__table__
+
+        base = select(
+            taxon.c.taxid.label("ancestor_taxid"),
+            taxon.c.taxid.label("descendant_taxid"),
+            literal(0).label("depth"),
+        ).cte("closure", recursive=True)
+
+        parent = taxon.alias("parent")
+        step = (
+            select(
+                parent.c.parent_taxid,
+                base.c.descendant_taxid,
+                base.c.depth + 1,
+            )
+            .join_from(base, parent, parent.c.taxid == base.c.ancestor_taxid)
+            .where(parent.c.parent_taxid.isnot(None))
+            .where(parent.c.parent_taxid != parent.c.taxid)
+        )
+        pairs = base.union_all(step)
 
-        logger.info("Adding to database.")
         with self.get_session() as session:
-            session.add(tree)
+            session.execute(closure.delete())
+            session.execute(closure.insert().from_select(
+                ["ancestor_taxid", "descendant_taxid", "depth"],
+                select(pairs)
+            ))
+            count = session.query(func.count()).select_from(closure).scalar()
+
+        logger.info("Rebuilt the taxon hierarchy with %s pairs.", count)
+        self.rebuild_lineage()
         return
 
+    def rebuild_lineage(self):
+        """ Rebuild the taxon lineage table from the closure table.
+
+        Each taxon gets the taxid and name of its ancestor at each of
+        db.LINEAGE_RANKS, or nulls if it has none at that rank.
+        """
+
+        lineage = db.taxonlineage
+        lineage.create(self.engine, checkfirst=True)
+        closure = db.TaxonClosure.__table__
+        ancestor = db.Taxon.__table__
+
+        columns = [closure.c.descendant_taxid]
+        for rank in db.LINEAGE_RANKS:
+            at_rank = ancestor.c.rank == rank
+            columns.append(func.max(case((at_rank, ancestor.c.taxid))))
+            columns.append(func.max(case((at_rank, ancestor.c.name))))
+
+        ranks = (
+            select(*columns)
+            .join_from(closure, ancestor,
+                       ancestor.c.taxid == closure.c.ancestor_taxid)
+            .group_by(closure.c.descendant_taxid)
+        )
+
+        with self.get_session() as session:
+            session.execute(lineage.delete())
+            session.execute(lineage.insert().from_select(
+                [c.name for c in lineage.columns],
+                ranks
+            ))
+        return
+
+    def rank_lineage(self, taxids):
+        """ The main rank ancestors of taxa as a DataFrame. """
+
+        lineage = db.taxonlineage
+        with self.get_session() as session:
+            rows = session.execute(
+                lineage.select()
+                .where(lineage.c.taxid.in_(taxids))
+                .order_by(lineage.c.taxid)
+            ).all()
+
+        return pd.DataFrame.from_records(
+            rows,
+            columns=[c.name for c in lineage.columns]
+        )
+
+    def _related(self, taxid, down=True, depth=None):
+        closure = db.TaxonClosure
+        if down:
+            this, other = closure.ancestor_taxid, closure.descendant_taxid
+        else:
+            this, other = closure.descendant_taxid, closure.ancestor_taxid
+
+        with self.get_session() as session:
+            query = (
+                session.query(
+                    db.Taxon.taxid,
+                    db.Taxon.name,
+                    db.Taxon.rank,
+                    db.Taxon.parent_taxid,
+                    closure.depth,
+                )
+                .join(closure, other == db.Taxon.taxid)
+                .filter(this == taxid)
+            )
+
+            if depth is not None:
+                query = query.filter(closure.depth <= depth)
+
+            rows = query.order_by(closure.depth, db.Taxon.taxid).all()
+
+        return pd.DataFrame.from_records(
+            rows,
+            columns=["taxid", "name", "rank", "parent_taxid", "depth"]
+        )
+
+    def descendants(self, taxid, depth=None):
+        """ The taxa under taxid (including itself), down to depth. """
+        return self._related(taxid, down=True, depth=depth)
+
+    def ancestors(self, taxid):
+        """ The lineage of taxid, from itself up to the root. """
+        return self._related(taxid, down=False)
+
+    def lowest_common_ancestor(self, taxids):
+        """ The deepest taxon that is an ancestor of all taxids.
+
+        Returns None if they don't share an ancestor.
+        """
+
+        taxids = set(taxids)
+        closure = db.TaxonClosure
+        with self.get_session() as session:
+            row = (
+                session.query(closure.ancestor_taxid)
+                .filter(closure.descendant_taxid.in_(taxids))
+                .group_by(closure.ancestor_taxid)
+                .having(func.count(closure.descendant_taxid) == len(taxids))
+                .order_by(func.min(closure.depth))
+                .first()
+            )
+
+        if row is None:
+            return None
+        return row[0]
+
+    def samples(self, taxid):
+        """ The sample taxon rows for all taxa under taxid. """
+
+        closure = db.TaxonClosure
+        with self.get_session() as session:
+            rows = (
+                session.query(
+                    db.SampleTaxon.sample_id,
+                    db.SampleTaxon.taxon_id,
+                    db.SampleTaxon.type,
+                )
+                .join(closure,
+                      closure.descendant_taxid == db.SampleTaxon.taxon_id)
+                .filter(closure.ancestor_taxid == taxid)
+                .order_by(db.SampleTaxon.sample_id)
+                .all()
+            )
+
+        frame = pd.DataFrame.from_records(
+            rows,
+            columns=["sample_id", "taxid", "type"]
+        )
+        frame["type"] = [key_value(t) for t in frame["type"]]
+        return frame
+
 
 class SampleTaxon(SamplyBase):
 
@@ -93,13 +326,22 @@ class SampleTaxon(SamplyBase):
     """
 
     table = db.SampleTaxon
+    references = {
+        "sample_id": ("sample_id", db.Sample.id),
+        "taxid": ("taxon_id", db.Taxon.taxid),
+    }
+    natural_key = ("sample_id", "taxon_id", "type")
+    dump_types = {
+        "taxid": "int",
+        "type": voc.SampleTaxonType,
+    }
 
     @staticmethod
     def _to_series(record):
 
         data = [
-            record.sample.id,
-            record.taxon.taxid,
+            record.sample_id,
+            record.taxon_id,
             record.type.name,
             json.dumps(record.evidence)
         ]
@@ -126,22 +368,12 @@ class SampleTaxon(SamplyBase):
             evidence=evidence
         )
 
-    def add_records(self, records):
-        """ Recursively add records to database """
-
-        with self.get_session() as session:
-            for record in records:
-                taxid = record.pop("taxid")
-                sample_id = record.pop("sample_id")
-
-                record = utils.tidy_nans(record)
-                sample = session.query(db.Sample).filter(
-                    db.Sample.id == sample_id).one()
-                taxon = session.query(db.Taxon).filter(
-                    db.Taxon.taxid == taxid).one()
-
-                record["taxon"] = taxon
-                record["sample"] = sample
-                record = self.table(**record)
-                session.add(record)
-        return
+    @staticmethod
+    def _from_frame(table):
+        frame = pd.DataFrame({
+            "sample_id": table["sample_id"],
+            "taxid": table["taxid"],
+            "type": table["type"],
+            "evidence": utils.array_column(table["evidence"]),
+        })
+        return utils.frame_to_records(frame)
@@ -2,11 +2,26 @@
 
 import logging
 
+import enum
+import json
+import hashlib
 import functools
 import inspect
-from collections import Iterable
+import itertools
+from datetime import date
+from datetime import timedelta
+from collections.abc import Iterable
 
+import numpy as np
 import pandas as pd
+from sqlalchemy import case
+from sqlalchemy import cast
+from sqlalchemy import Date
+from sqlalchemy import extract
+from sqlalchemy import func
+from sqlalchemy import Integer
+from sqlalchemy import String
+from sqlalchemy.dialects.postgresql import Range
 
 
 def log(logger, level=logging.DEBUG):
@@ -68,3 +83,233 @@ def tidy_nans(d):
         else:
             output[k] = v
     return output
+
+
+def frame_to_records(frame):
+    """ Convert a DataFrame to a list of dicts, replacing missing scalar
+    values with None.
+    This is the column-wise equivalent of calling tidy_nans on each row.
+    """
+    frame = frame.astype(object)
+    frame = frame.where(frame.notna(), None)
+    return frame.to_dict("records")
+
+
+def array_column(column, sep=";"):
+    """ Split a column of delimited strings into lists.
+    Values that are already lists are kept, arrays (e.g. from arrow list
+    columns) are converted to lists, anything else becomes an empty list.
+    """
+    return pd.Series(
+        [
+            v.split(sep) if isinstance(v, str)
+            else v if isinstance(v, list)
+            else v.tolist() if isinstance(v, np.ndarray)
+            else []
+            for v in column
+        ],
+        index=column.index,
+        dtype=object,
+    )
+
+
+def json_column(column):
+    """ Parse a column of json strings into dicts.
+    Values that are already dicts are kept, anything else becomes an
+    empty dict.
+    """
+    return pd.Series(
+        [
+            json.loads(v) if isinstance(v, str)
+            else v if isinstance(v, dict)
+            else {}
+            for v in column
+        ],
+        index=column.index,
+        dtype=object,
+    )
+
+
+def enum_column(column, enum):
+    """ Map a column of enum names to the enum members.
+    Raises a KeyError for the first value that isn't a member name, the
+    same as indexing the enum directly would.
+    """
+    members = {m.name: m for m in enum}
+    mapped = column.map(members)
+    invalid = mapped.isna()
+    if invalid.any():
+        raise KeyError(column[invalid].iloc[0])
+    return mapped.astype(object)
+
+
+def datetime_column(column, format="%Y-%m-%d"):
+    """ Parse a column of date strings into datetime objects.
+    Columns that are already typed as dates or datetimes aren't parsed.
+    """
+    if column.isna().any():
+        raise ValueError("Missing values in date column {}".format(
+            column.name))
+
+    if pd.api.types.is_datetime64_any_dtype(column):
+        parsed = column
+    elif column.map(lambda d: isinstance(d, date)).all():
+        parsed = pd.to_datetime(column)
+    else:
+        parsed = pd.to_datetime(column, format=format)
+    return pd.Series(
+        [d.to_pydatetime() for d in parsed],
+        index=column.index,
+        dtype=object,
+    )
+
+
+def date_column(column, format="%Y-%m-%d"):
+    """ Parse a column of date strings into date objects. """
+    if (not column.isna().any() and
+            column.map(lambda d: type(d) is date).all()):
+        return column.astype(object)
+    return datetime_column(column, format).map(lambda d: d.date())
+
+
+def _add_months(d, months):
+    month = d.month - 1 + months
+    return date(d.year + month // 12, month % 12 + 1, 1)
+
+
+def date_range(d, resolution):
+    """ The [start, end) dates that a date at some resolution could be.
+
+    Weeks are ISO weeks starting on monday, seasons are meteorological
+    (starting in December, March, June and September). None means
+    unbounded, for "before" and "after" dates.
+    Returns a tuple of start and end dates.
+    """
+
+    if isinstance(resolution, enum.Enum):
+        resolution = resolution.name
+
+    if resolution == "day":
+        return d, d + timedelta(days=1)
+    elif resolution == "week":
+        start = d - timedelta(days=d.weekday())
+        return start, start + timedelta(days=7)
+    elif resolution == "month":
+        start = d.replace(day=1)
+        return start, _add_months(start, 1)
+    elif resolution == "quarter":
+        start = date(d.year, 3 * ((d.month - 1) // 3) + 1, 1)
+        return start, _add_months(start, 3)
+    elif resolution == "season":
+        start = _add_months(d.replace(day=1), -(d.month % 3))
+        return start, _add_months(start, 3)
+    elif resolution == "year":
+        return date(d.year, 1, 1), date(d.year + 1, 1, 1)
+    elif resolution == "decade":
+        start = d.year - d.year % 10
+        return date(start, 1, 1), date(start + 10, 1, 1)
+    elif resolution == "after":
+        return d, None
+    elif resolution == "before":
+        return None, d + timedelta(days=1)
+    else:
+        raise ValueError("Unknown date resolution {}.".format(resolution))
+
+
+def date_range_column(dates, resolutions):
+    """ Postgres date ranges for columns of dates and resolutions. """
+    return pd.Series(
+        [Range(*date_range(d, r), bounds="[)")
+         for d, r in zip(dates, resolutions)],
+        index=dates.index,
+        dtype=object
+    )
+
+
+def date_range_expression(d, resolution):
+    """ The SQL equivalent of date_range_column, for postgres.
+
+    d and resolution are date and DateResolution column expressions.
+    Rows missing either get an unbounded range, so filter them out first.
+    """
+
+    def trunc(field):
+        return func.date_trunc(field, d)
+
+    def months(n):
+        return func.make_interval(0, n)
+
+    year = cast(extract("year", d), Integer)
+    month = cast(extract("month", d), Integer)
+    season = trunc("month") - months(month % 3)
+    decade = func.make_date(year - year % 10, 1, 1)
+
+    bounds = {
+        "day": (d, d + 1),
+        "week": (trunc("week"), trunc("week") + func.make_interval(0, 0, 1)),
+        "month": (trunc("month"), trunc("month") + months(1)),
+        "quarter": (trunc("quarter"), trunc("quarter") + months(3)),
+        "season": (season, season + months(3)),
+        "year": (trunc("year"), trunc("year") + months(12)),
+        "decade": (decade, decade + months(120)),
+        "after": (d, None),
+        "before": (None, d + 1),
+    }
+
+    name = cast(resolution, String)
+    lower = case(
+        {k: cast(v[0], Date) for k, v in bounds.items() if v[0] is not None},
+        value=name
+    )
+    upper = case(
+        {k: cast(v[1], Date) for k, v in bounds.items() if v[1] is not None},
+        value=name
+    )
+    return func.daterange(lower, upper, "[)")
+
+
+def file_digest(path, blocksize=2 ** 20):
+    """ The sha256 hex digest of a file.
+    Accepts a path or an open file object with a name. Returns None if
+    the file can't be reopened, e.g. for stdin.
+    """
+    name = getattr(path, "name", path)
+    digest = hashlib.sha256()
+
+    try:
+        with open(name, "rb") as handle:
+            for block in iter(lambda: handle.read(blocksize), b""):
+                digest.update(block)
+    except (OSError, TypeError):
+        return None
+
+    return digest.hexdigest()
+
+
+def _json_default(value):
+    if isinstance(value, enum.Enum):
+        return value.name
+    elif isinstance(value, date):
+        return value.isoformat()
+    elif isinstance(value, bytes):
+        return value.hex()
+    else:
+        return str(value)
+
+
+def record_digest(record):
+    """ A compact hash of a normalised record.
+    Keys are sorted, so the digest doesn't depend on column order.
+    """
+    text = json.dumps(record, sort_keys=True, default=_json_default)
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def batched(iterable, size):
+    """ Yield lists of up to size items from an iterable. """
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if len(batch) == 0:
+            return
+        yield batch
@@ -84,6 +84,7 @@ setup(
         'geoalchemy2',
         'sqlalchemy',
         'pandas',
+        'shapely>=2',
         ],
 
     # List additional groups of dependencies here (e.g. development
@@ -93,6 +94,7 @@ setup(
     extras_require={
         'dev': ['check-manifest'],
         'test': ['coverage', "pytest"],
+        'columnar': ['pyarrow'],
     },
 
     # If there are data files included in your packages that need to be
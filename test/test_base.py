@@ -0,0 +1,48 @@
+import pytest
+from sqlalchemy import create_engine
+
+from samply.samples import Samples
+
+
+@pytest.fixture
+def samples():
+    return Samples(create_engine("sqlite://"))
+
+
+def record(id_, *parents):
+    return {"id": id_, "parents": list(parents)}
+
+
+def test_topological_order(samples):
+    records = [
+        record("c", "b"),
+        record("b", "a"),
+        record("d", "a", "c"),
+        record("a", "outside"),
+    ]
+    order = [r["id"] for r in samples._topological_order(records)]
+    assert sorted(order) == ["a", "b", "c", "d"]
+    for r in records:
+        for parent in r["parents"]:
+            if parent != "outside":
+                assert order.index(parent) < order.index(r["id"])
+
+
+def test_topological_order_deep(samples):
+    records = [record("0")] + [
+        record(str(i), str(i - 1)) for i in range(1, 5000)
+    ]
+    order = samples._topological_order(records[::-1])
+    assert [r["id"] for r in order] == [str(i) for i in range(5000)]
+
+
+def test_topological_order_duplicates(samples):
+    with pytest.raises(ValueError, match="Duplicate keys: a"):
+        samples._topological_order([record("a"), record("b"), record("a")])
+
+
+def test_topological_order_cycle(samples):
+    records = [record("a", "c"), record("b", "a"), record("c", "b"),
+               record("d"), record("e", "d")]
+    with pytest.raises(ValueError, match="cycle: a, b, c"):
+        samples._topological_order(records)
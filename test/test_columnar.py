@@ -0,0 +1,62 @@
+from datetime import date
+
+import pandas as pd
+import pytest
+
+from samply import columnar
+from samply.vocabularies import DateResolution
+
+pytest.importorskip("pyarrow")
+
+TYPES = {
+    "names": "list",
+    "date": "date",
+    "taxid": "int",
+    "date_resolution": DateResolution,
+}
+
+
+def frames(n, size):
+    for start in range(0, n, size):
+        yield pd.DataFrame({
+            "id": ["s{}".format(i) for i in range(start, start + size)],
+            "names": [["a", "b"]] + [[]] * (size - 1),
+            "date": [date(2019, 1, 1 + i % 28)
+                     for i in range(start, start + size)],
+            "taxid": [i for i in range(start, start + size)],
+            "date_resolution": ["day"] * size,
+        })
+
+
+@pytest.mark.parametrize("format", ["parquet", "arrow"])
+def test_round_trip(tmp_path, format):
+    path = tmp_path / ("table." + format)
+    columnar.write_batches(frames(12, 4), str(path), TYPES, format)
+
+    table = columnar.read_table(str(path), format)
+    assert list(table["id"]) == ["s{}".format(i) for i in range(12)]
+    assert list(table["names"][0]) == ["a", "b"]
+    assert list(table["names"][1]) == []
+    assert table["date"][3] == date(2019, 1, 4)
+    assert list(table["taxid"]) == list(range(12))
+    assert set(table["date_resolution"]) == {"day"}
+
+
+@pytest.mark.parametrize("format", ["parquet", "arrow"])
+@pytest.mark.parametrize("skip", [0, 3, 4, 5, 11, 12])
+def test_read_batches_skip(tmp_path, format, skip):
+    path = tmp_path / ("table." + format)
+    columnar.write_batches(frames(12, 4), str(path), TYPES, format)
+
+    batches = list(columnar.read_batches(
+        str(path), format, chunksize=5, skip=skip))
+    assert all(len(b) <= 5 for b in batches)
+
+    ids = [i for b in batches for i in b["id"]]
+    assert ids == ["s{}".format(i) for i in range(skip, 12)]
+
+
+def test_input_format():
+    assert columnar.input_format("a/b.parquet") == "parquet"
+    assert columnar.input_format("b.FEATHER") == "arrow"
+    assert columnar.input_format("b.tsv") == "tsv"
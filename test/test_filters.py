@@ -0,0 +1,54 @@
+import operator
+from datetime import date
+
+import pytest
+
+from samply import database as db
+from samply import filters
+from samply.vocabularies import SamplePermission
+
+COLUMNS = dict(db.Sample.__table__.c.items())
+
+
+def test_parse_filter_converts_values():
+    clause = filters.parse_filter(COLUMNS, "date >= 2019-01-01")
+    assert clause.left is COLUMNS["date"]
+    assert clause.operator is operator.ge
+    assert clause.right.value == date(2019, 1, 1)
+
+    clause = filters.parse_filter(COLUMNS, "permission=private")
+    assert clause.right.value is SamplePermission.private
+
+
+@pytest.mark.parametrize("op,expected", [
+    ("=", operator.eq), ("==", operator.eq), ("!=", operator.ne),
+    ("<", operator.lt), ("<=", operator.le),
+    (">", operator.gt), (">=", operator.ge),
+])
+def test_parse_filter_operators(op, expected):
+    clause = filters.parse_filter(COLUMNS, "id" + op + "s1")
+    assert clause.operator is expected
+    assert clause.right.value == "s1"
+
+
+def test_parse_filter_any_of():
+    clause = filters.parse_filter(COLUMNS, "permission=private, commercial")
+    assert clause.operator.__name__ == "in_op"
+    assert clause.right.value == [
+        SamplePermission.private, SamplePermission.commercial]
+
+
+@pytest.mark.parametrize("string", [
+    "date", "nothing>=1", "permission=nobody", "date>=yesterday",
+])
+def test_parse_filter_errors(string):
+    with pytest.raises((ValueError, KeyError)):
+        filters.parse_filter(COLUMNS, string)
+
+
+def test_compile_filters_passes_expressions():
+    expression = db.Sample.id == "s1"
+    clauses = filters.compile_filters(COLUMNS, ["id=s2", expression])
+    assert len(clauses) == 2
+    assert clauses[1] is expression
+    assert filters.compile_filters(COLUMNS, None) == []
@@ -0,0 +1,56 @@
+from datetime import date
+
+from sqlalchemy.dialects.postgresql import Range
+
+from samply import database as db
+from samply import pgcopy
+from samply.vocabularies import DateResolution
+
+SAMPLE = db.Sample.__table__.c
+TAXON = db.Taxon.__table__.c
+
+
+def test_format_value_scalars():
+    assert pgcopy.format_value(SAMPLE.id, None) == "\\N"
+    assert pgcopy.format_value(SAMPLE.id, "s1") == "s1"
+    assert pgcopy.format_value(TAXON.taxid, 9606) == "9606"
+    assert pgcopy.format_value(SAMPLE.date, date(2019, 2, 3)) == "2019-02-03"
+    assert pgcopy.format_value(
+        SAMPLE.date_resolution, DateResolution.week) == "week"
+    assert pgcopy.format_value(TAXON.taxid, float("nan")) == "\\N"
+
+
+def test_format_value_escapes():
+    assert pgcopy.format_value(SAMPLE.id, "a\tb\nc\\d\re") == (
+        "a\\tb\\nc\\\\d\\re")
+
+
+def test_format_value_json():
+    assert pgcopy.format_value(SAMPLE.names, ["a", "b"]) == '["a", "b"]'
+    assert pgcopy.format_value(SAMPLE.details, {"x": "a\tb"}) == (
+        '{"x": "a\\\\tb"}')
+
+
+def test_format_value_geometry():
+    assert pgcopy.format_value(SAMPLE.geom, b"\x01\x02") == "0102"
+    assert pgcopy.format_value(
+        SAMPLE.geom, "SRID=4326;POINT(1 2)") == "SRID=4326;POINT(1 2)"
+
+
+def test_format_range():
+    assert pgcopy.format_range(
+        Range(date(2019, 2, 1), date(2019, 3, 1), bounds="[)")
+    ) == "[2019-02-01,2019-03-01)"
+    assert pgcopy.format_range(
+        Range(date(2019, 2, 1), None, bounds="[)")
+    ) == "[2019-02-01,)"
+    assert pgcopy.format_range(
+        Range(None, date(2019, 3, 1), bounds="[)")
+    ) == "(,2019-03-01)"
+    assert pgcopy.format_range(Range(empty=True)) == "empty"
+
+
+def test_format_value_range():
+    value = Range(date(2019, 2, 1), date(2019, 3, 1), bounds="[)")
+    assert pgcopy.format_value(SAMPLE.date_range, value) == (
+        "[2019-02-01,2019-03-01)")
@@ -0,0 +1,86 @@
+""" The column-wise _from_frame conversions match the row by row ones. """
+
+import io
+
+import pandas as pd
+import pytest
+
+from samply import utils
+from samply.contributors import Contributors
+from samply.contributors import SampleContribution
+from samply.pesticides import Pesticide
+from samply.pesticides import SamplePesticide
+from samply.samples import Samples
+from samply.taxon import SampleTaxon
+from samply.taxon import Taxon
+
+
+def read(*lines):
+    return pd.read_table(io.StringIO("\n".join(lines) + "\n"))
+
+
+def from_series(cls, table):
+    return [
+        utils.tidy_nans(cls._from_series(row))
+        for _, row in table.iterrows()
+    ]
+
+
+TABLES = [
+    (Samples, read(
+        "id\tnames\ttype\tdate\tdate_resolution\tdetails\tpermission\t"
+        "parents\tgeom\tlocation_type\tlatitude\tlongitude\t"
+        "street_address\tsuburb\tstate\tcountry\tlocation_support",
+        "s1\ta;b\tsample\t2019-02-03\tday\t{\"x\": 1}\tnoncommercial\t\t"
+        "POINT(150 -30)\tpoint\t-30\t150\t1 Main St\t\tNSW\tAU\t{}",
+        "s2\t\tsample\t2019-05-01\tseason\t\tnoncommercial\ts1\t\tpoint\t"
+        "-31.5\t151\t\t\t\t\t{\"note\": \"y\"}",
+    )),
+    (Taxon, read(
+        "taxid\tparent_taxid\tname\talt_names\trank",
+        "1\t\troot\t\tno rank",
+        "2\t1\tA\tAa;Ab\tgenus",
+    )),
+    (SampleTaxon, read(
+        "sample_id\ttaxid\ttype\tevidence",
+        "s1\t2\thost\tpcr;morphology",
+        "s2\t1\thost\t",
+    )),
+    (Pesticide, read(
+        "name\tpesticide_type\ttype\tgroup\tnotes\tparents",
+        " Thing \tfungicide;insecticide\tproduct\tgroup 1;group 2\t"
+        "some notes\t",
+        "other\tfungicide\tproduct\t\t\tthing",
+    )),
+    (SamplePesticide, read(
+        "sample_id\tpesticide_name\tdate\tdate_resolution\trate\tunits\t"
+        "application_style\tstage_applied\tnotes",
+        "s1 \t Thing\t2019-02-03\tmonth\t1.5\tL/ha\tfoliar\tflowering\t",
+        "s2\tother\t2019-02-03\tbefore\t\t\tfoliar\t\tlate",
+    )),
+    (Contributors, read(
+        "type\tname\tcontact\tphone\temail",
+        "person\tA Person\t{\"web\": \"a.org\"}\t12345\ta@b.org",
+        "organisation\tAn Org\t\t\t",
+    )),
+    (SampleContribution, read(
+        "sample_id\tcontributor_name\tpredicate\tdatetime",
+        "s1\tA Person\tcollected_by\t2019-02-03",
+    )),
+]
+
+
+@pytest.mark.parametrize(
+    "cls,table", TABLES, ids=[c.__name__ for c, _ in TABLES])
+def test_from_frame_matches_from_series(cls, table):
+    assert cls._from_frame(table) == from_series(cls, table)
+
+
+def test_taxon_ids_stay_integer():
+    table = read("taxid\tparent_taxid\tname\talt_names\trank",
+                 "1\t\troot\t\tno rank",
+                 "2\t1\tA\t\tgenus")
+    records = Taxon._from_frame(table)
+    assert [r["parent_taxid"] for r in records] == [None, 1]
+    assert all(type(r["taxid"]) is int for r in records)
+    assert type(records[1]["parent_taxid"]) is int
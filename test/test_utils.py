@@ -0,0 +1,46 @@
+from datetime import date
+
+import pytest
+
+from samply import utils
+from samply.vocabularies import DateResolution
+
+
+@pytest.mark.parametrize("resolution,expected", [
+    ("day", (date(2019, 2, 13), date(2019, 2, 14))),
+    ("week", (date(2019, 2, 11), date(2019, 2, 18))),
+    ("month", (date(2019, 2, 1), date(2019, 3, 1))),
+    ("quarter", (date(2019, 1, 1), date(2019, 4, 1))),
+    ("season", (date(2018, 12, 1), date(2019, 3, 1))),
+    ("year", (date(2019, 1, 1), date(2020, 1, 1))),
+    ("decade", (date(2010, 1, 1), date(2020, 1, 1))),
+    ("after", (date(2019, 2, 13), None)),
+    ("before", (None, date(2019, 2, 14))),
+])
+def test_date_range(resolution, expected):
+    assert utils.date_range(date(2019, 2, 13), resolution) == expected
+
+
+@pytest.mark.parametrize("day,expected", [
+    (date(2019, 3, 1), (date(2019, 3, 1), date(2019, 6, 1))),
+    (date(2019, 8, 31), (date(2019, 6, 1), date(2019, 9, 1))),
+    (date(2019, 12, 25), (date(2019, 12, 1), date(2020, 3, 1))),
+    (date(2020, 1, 1), (date(2019, 12, 1), date(2020, 3, 1))),
+])
+def test_date_range_seasons(day, expected):
+    assert utils.date_range(day, "season") == expected
+
+
+def test_date_range_takes_enums():
+    assert (utils.date_range(date(2019, 2, 13), DateResolution.month) ==
+            utils.date_range(date(2019, 2, 13), "month"))
+
+
+def test_date_range_unknown_resolution():
+    with pytest.raises(ValueError):
+        utils.date_range(date(2019, 2, 13), "fortnight")
+
+
+def test_batched():
+    assert list(utils.batched(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(utils.batched([], 2)) == []